@@ -1,43 +1,106 @@
 # -*- coding: utf-8 -*-
+from __future__ import annotations # SDK types in annotations stay unevaluated until the SDK is imported
 import sys
 import os
 import time
 import configparser
-import re
-import mimetypes
-from typing import Union, Dict, List, Optional, Tuple, Any
+from typing import Union, Dict, List, Optional, Tuple, Any, Iterable
 import json
+import logging
+import hashlib
+import threading
+import concurrent.futures
+import importlib.util
+import functools
+import io
+import datetime
+from array import array
+from dataclasses import dataclass, field
+from collections import defaultdict, OrderedDict
 
 # --- PySide6 Imports ---
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QFormLayout,
     QLabel, QLineEdit, QTextEdit, QPushButton, QComboBox, QListWidget, QFileDialog,
-    QMessageBox, QGroupBox, QFrame, QStackedWidget, QDoubleSpinBox
+    QMessageBox, QGroupBox, QFrame, QStackedWidget, QDoubleSpinBox, QSpinBox, QCheckBox
 )
-from PySide6.QtCore import Qt, QObject, Signal, QThread, Slot, QTimer, QSize
-from PySide6.QtGui import QFont, QColor # Removed unused Palette, Icon, Pixmap
+from PySide6.QtCore import Qt, QObject, QRunnable, QThreadPool, Signal, Slot, QTimer, QSize, QSignalBlocker
+from PySide6.QtGui import QFont, QColor, QTextCursor, QTextCharFormat # Removed unused Palette, Icon, Pixmap
 
-# --- AI Imports ---
+# --- Optional fast JSON (orjson) for the config's embedded JSON ---
 try:
-    import google.generativeai as genai
-    # Use ContentDict for history structure
-    from google.generativeai.types import GenerationConfigDict, File, ContentDict, HarmCategory, HarmBlockThreshold
-    from google.generativeai.generative_models import GenerativeModel, ChatSession # Import ChatSession
-    import google.api_core.exceptions
-    gemini_imported = True
+    import orjson
+    _json_loads = orjson.loads
+    def _json_dumps(obj) -> str: return orjson.dumps(obj).decode('utf-8') # Compact and non-ASCII kept, like the json fallback
 except ImportError:
-    # ... (error handling as before) ...
+    _json_loads = json.loads
+    def _json_dumps(obj) -> str: return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+log = logging.getLogger(__name__) # Worker threads log here; DEBUG is silent unless configured
+
+# --- AI Imports (deferred) ---
+# google.generativeai pulls in protobuf + gRPC, so it is only imported once AI is actually used.
+# Only check that it is installed here; _ensure_genai() binds the names below on first use.
+try:
+    gemini_imported = importlib.util.find_spec("google.generativeai") is not None
+except (ImportError, ValueError):
     gemini_imported = False
-except Exception as e:
-    # ... (error handling as before) ...
-    gemini_imported = False; sys.exit(1)
+genai = None
+GenerationConfigDict = File = ContentDict = HarmCategory = HarmBlockThreshold = None
+GenerativeModel = ChatSession = None
+_genai_import_lock = threading.Lock()
+
+def _ensure_genai() -> bool:
+    """Imports the Gemini SDK on first call. Returns False if it is not available."""
+    global genai, google, gemini_imported
+    global GenerationConfigDict, File, ContentDict, HarmCategory, HarmBlockThreshold, GenerativeModel, ChatSession
+    if genai is not None: return True
+    if not gemini_imported: return False
+    with _genai_import_lock:
+        if genai is not None: return True # Imported by another thread meanwhile
+        try:
+            # Use ContentDict for history structure
+            from google.generativeai.types import GenerationConfigDict, File, ContentDict, HarmCategory, HarmBlockThreshold
+            from google.generativeai.generative_models import GenerativeModel, ChatSession # Import ChatSession
+            import google.api_core.exceptions
+            import google.generativeai as genai # Bound last: other threads treat it as "import done"
+        except ImportError as e:
+            log.warning("Could not import Google AI library: %s", e) # Runs on pool threads
+            gemini_imported = False
+    return genai is not None
+
+# --- Semantic Cache Imports (optional, deferred) ---
+# sentence-transformers pulls in torch; it is loaded in the pool only if the setting is enabled.
+try:
+    semantic_cache_available = all(importlib.util.find_spec(m) is not None for m in ("sentence_transformers", "numpy"))
+except (ImportError, ValueError):
+    semantic_cache_available = False
 
 # --- Constants ---
 CONFIG_FILE = 'konenako_simple_config.ini'
+UPLOAD_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.aipdfteacher', 'upload_cache.json') # {sha256: File API handle}, shared by all working dirs
+UPLOAD_DEFAULT_LIFETIME = 47 * 3600 # Seconds an upload is assumed usable if the backend reports no expiry (File API keeps files 48 h)
 DEFAULT_MODEL = 'gemini-1.5-flash-latest' # Use latest flash
 DEFAULT_LANGUAGE = 'Finnish'
 LANGUAGES = ['Finnish', 'English']
 DEFAULT_TEMPERATURE = 0.6 # Slightly higher for more natural convo?
+DEFAULT_HISTORY_LIMIT = 30 # Chat messages kept verbatim before older ones are summarized
+MIME_BY_EXT = {'.pdf': 'application/pdf', '.md': 'text/markdown'} # Matches the file dialog filter
+MAX_POOL_THREADS = 4 # Background tasks are network-bound; a small pool is plenty for Python
+MAX_PARALLEL_UPLOADS = 4 # Upload is network-bound; more threads don't help under the GIL
+MAX_PARALLEL_DELETES = 8 # Deletes are tiny independent HTTPS calls
+USER_BATCH_WINDOW_MS = 300 # Messages typed within this window after an AI answer are sent as one turn
+RESPONSE_CACHE_SIZE = 128 # AI answers remembered for identical (model, document, prompt, history, message) turns
+SEMANTIC_CACHE_MODEL = "all-MiniLM-L6-v2" # Small local sentence embedder (384 dims)
+SEMANTIC_CACHE_THRESHOLD = 0.92 # Cosine similarity above which a previous answer is reused
+SEMANTIC_CACHE_BUCKET = 10 # Questions only match within the same model, document, upload, prompt and history-length bucket
+SEMANTIC_CACHE_MIN_WORDS = 4 # Shorter messages ("yes", "continue", "next exercise please") depend on context, never matched
+SEMANTIC_CACHE_SLOT_SIZE = 64 # Newest questions kept per slot
+CONTEXT_CACHE_TTL = datetime.timedelta(hours=1) # Lifetime of a server-side cache of document + system prompt
+CONTEXT_CACHE_REUSE_MARGIN = datetime.timedelta(minutes=5) # A context cache closer than this to expiry is replaced, not reused
+MAX_HISTORY_TOKENS = 8000 # Estimated text tokens of history sent per turn; older turns beyond it are dropped
+CLEAN_FINISH_REASONS = ('FINISH_REASON_UNSPECIFIED', 'STOP', 'MAX_TOKENS') # Any other reason leaves a ChatSession unreadable until rewound
+SUMMARY_REQUEST = "Summarize the following tutor conversation in about 200 words for continuity:"
 # MUISTILAPPU_BASENAME = "konenako_muistilappu_v2.md" # May not be needed explicitly if just another doc
 
 # --- Styling (Optional) ---
@@ -45,172 +108,712 @@ APP_BG_COLOR = "#F0F4F8"; CHAT_BG = "#FFFFFF"; INPUT_BG="#FFFFFF"; STATUS_BG="#E
 AI_MSG_COLOR = "#263238"; USER_MSG_COLOR = "#00695C"; SYSTEM_MSG_COLOR="#546E7A"; ERROR_MSG_COLOR="#D32F2F";
 BUTTON_COLOR = "#1E88E5"; BUTTON_HOVER_COLOR = "#1565C0"; BUTTON_TEXT_COLOR = "#FFFFFF"; FONT_FAMILY = "Segoe UI"
 
+# Whole-window QSS, rendered once; Qt parses it a single time in apply_stylesheet()
+_STYLESHEET = f"""
+    QMainWindow {{ background-color: {APP_BG_COLOR}; }}
+    QGroupBox {{ font-weight: bold; border: 1px solid #ccc; border-radius: 4px; margin-top: 10px; padding: 10px; }}
+    QGroupBox::title {{ subcontrol-origin: margin; subcontrol-position: top left; padding: 0 5px; left: 10px; }}
+    QPushButton {{ background-color: #E0E0E0; border: 1px solid #bbb; border-radius: 3px; padding: 5px 10px; min-height: 20px;}}
+    QPushButton:hover {{ background-color: #d0d0d0; border: 1px solid #999; }}
+    QPushButton:disabled {{ background-color: #f5f5f5; color: #aaa; }}
+    #SendButton, #UploadButton, #ApplyButton {{ background-color: {BUTTON_COLOR}; color: {BUTTON_TEXT_COLOR}; border: none; }}
+    #SendButton:hover, #UploadButton:hover, #ApplyButton:hover {{ background-color: {BUTTON_HOVER_COLOR}; }}
+    #BackButton {{ /* Custom style if needed */ }}
+    QLineEdit, QComboBox, QDoubleSpinBox, QTextEdit {{ border: 1px solid #ccc; border-radius: 3px; padding: 5px; background-color: #fff; }}
+    QListWidget {{ border: 1px solid #ccc; border-radius: 3px; background-color: #fff; }}
+    #Header {{ background-color: {APP_BG_COLOR}; border-bottom: 1px solid #ccc; padding: 5px; }}
+    #StatusBar {{ background-color: {STATUS_BG}; padding: 5px 10px; color: {SYSTEM_MSG_COLOR}; }}
+    #StatusBar[error="true"] {{ color: {ERROR_MSG_COLOR}; }}
+"""
+
+@functools.lru_cache(maxsize=None)
+def _bold_font(point_size: int) -> QFont:
+    """Shared bold UI font. QFont is implicitly shared, so handing out one instance is free;
+    it is created on first use because QFont needs the QApplication to exist."""
+    return QFont(FONT_FAMILY, point_size, QFont.Weight.Bold)
+
 # Role constants for chat history
 ROLE_AI = "model"
 ROLE_USER = "user"
 ROLE_SYSTEM = "system" # For internal status messages in chat UI
 
+# Escapes chat text for the HTML chat display in a single str.translate pass
+_HTML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '\n': '<br>'})
+
+# Chat message HTML, precomputed per role; each template takes only the escaped message body
+_MSG_TEMPLATE = '<div style="margin-bottom: 8px;"><b style="color:{color};">{prefix}</b><br><span style="color:{color};">{body}</span></div>'
+_ROLE_TEMPLATES = {
+    ROLE_AI: _MSG_TEMPLATE.format(color=AI_MSG_COLOR, prefix="🤖 AI Tutor:", body="%s"),
+    ROLE_USER: _MSG_TEMPLATE.format(color=USER_MSG_COLOR, prefix="👤 You:", body="%s"),
+    ROLE_SYSTEM: _MSG_TEMPLATE.format(color=SYSTEM_MSG_COLOR, prefix="ℹ️ System:", body="<i>%s</i>"), # Italicize system messages
+}
+_FALLBACK_TEMPLATE = _MSG_TEMPLATE.format(color="#000000", prefix="%s:", body="%s") # Takes (role, body)
+
+# ==================================
+# File Helpers
+# ==================================
+def _find_existing_files(paths: List[str]) -> set:
+    """Returns the subset of paths that exist, listing each parent directory once instead of stat-ing every file."""
+    paths_by_dir: Dict[str, List[str]] = defaultdict(list)
+    for path in paths:
+        paths_by_dir[os.path.dirname(path)].append(path)
+    existing = set()
+    for directory, dir_paths in paths_by_dir.items():
+        try:
+            with os.scandir(directory or '.') as entries:
+                present = {entry.name for entry in entries}
+        except OSError: # Directory itself is gone/unreadable: none of its files count as present
+            continue
+        existing.update(p for p in dir_paths if os.path.basename(p) in present)
+    return existing
+
+def _write_file_atomic(path: str, text: str):
+    """Writes text via a temp file + os.replace, so the file is never left half-written."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp" # Unique per writer thread
+    try:
+        with open(tmp_path, 'w', encoding='utf-8', buffering=1 << 16) as f:
+            f.write(text)
+            f.flush(); os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except OSError:
+        try: os.remove(tmp_path)
+        except OSError: pass
+        raise
+
+def _file_sha256(path: str) -> str:
+    """Hex sha256 of the whole file. Only called from worker threads; hashing releases the GIL."""
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'): # Python 3.11+: reads straight into OpenSSL's buffer, no Python-level loop
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        digest = hashlib.sha256()
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+        return digest.hexdigest()
+
+# ==================================
+# Upload Cache
+# ==================================
+class FileUploadCache:
+    """Remembers File API handles by content sha256, so identical local files are never uploaded twice."""
+    def __init__(self, path: str):
+        self.path = path
+        self._entries: Dict[str, Dict[str, Any]] = {} # {sha256: {"name": basename, "file_id", "expiry": unix time}}
+        self._lock = threading.Lock() # Accessed from the upload executor threads
+        self._dirty = False
+        self.load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def load(self):
+        if not os.path.exists(self.path): return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            now = time.time()
+            self._entries = {k: v for k, v in entries.items() if v.get('expiry', 0) > now} # Expired uploads are gone anyway
+            self._dirty = len(self._entries) != len(entries)
+            log.debug("Upload cache loaded: %d entries", len(self._entries))
+        except (OSError, json.JSONDecodeError, ValueError, AttributeError) as e:
+            log.warning("Error loading upload cache: %s. Starting empty.", e)
+            self._entries = {}
+
+    def get(self, sha256: str, basename: str) -> Optional[str]:
+        """Returns the file_id uploaded for this content under this basename, if not expired."""
+        with self._lock:
+            entry = self._entries.get(sha256)
+        # The basename must match: the main window maps uploaded files back by their display_name
+        if not entry or entry.get('name') != basename or entry.get('expiry', 0) <= time.time(): return None
+        return entry.get('file_id')
+
+    def put(self, sha256: str, file_obj: File):
+        expiration = getattr(file_obj, 'expiration_time', None)
+        expiry = expiration.timestamp() if hasattr(expiration, 'timestamp') else time.time() + UPLOAD_DEFAULT_LIFETIME
+        with self._lock:
+            self._entries[sha256] = {'name': file_obj.display_name, 'file_id': file_obj.name, 'expiry': expiry}
+            self._dirty = True
+
+    def discard(self, sha256: str):
+        with self._lock:
+            if self._entries.pop(sha256, None) is not None: self._dirty = True
+
+    def save(self):
+        """Writes the cache to disk (atomically) if it changed."""
+        with self._lock:
+            if not self._dirty: return
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                _write_file_atomic(self.path, json.dumps(self._entries)) # A crash mid-write can't truncate it
+                self._dirty = False
+            except OSError as e:
+                log.warning("Error saving upload cache: %s", e)
+
+# ==================================
+# Chat Transcript
+# ==================================
+_ROLE_CODES = {ROLE_AI: 0, ROLE_USER: 1, ROLE_SYSTEM: 2}
+_ROLES_BY_CODE = (ROLE_AI, ROLE_USER, ROLE_SYSTEM)
+
+@dataclass
+class _Transcript:
+    """Messages shown in the chat for one document, stored column-wise so switching documents is a cheap replay."""
+    roles: bytearray = field(default_factory=bytearray) # _ROLE_CODES values
+    ts: array = field(default_factory=lambda: array('d')) # time.time() of each message
+    texts: List[str] = field(default_factory=list)
+
+    def append(self, role: str, text: str):
+        self.roles.append(_ROLE_CODES[role]); self.ts.append(time.time()); self.texts.append(text)
+
+    def messages(self):
+        """Yields (role, text) pairs in display order."""
+        return ((_ROLES_BY_CODE[code], text) for code, text in zip(self.roles, self.texts))
+
+def _estimate_tokens(contents) -> int:
+    """Rough text token count of chat contents (~4 characters per token); file parts are not counted."""
+    return sum(len(getattr(part, 'text', '')) for content in contents for part in content.parts) // 4
+
 # ==================================
 # Worker Objects (Modified for Chat)
 # ==================================
-class AIChatWorker(QObject):
-    result_ready = Signal(str) # Only sends back the AI text response
+class _ChatSignals(QObject):
+    # QRunnable can't emit signals itself, so workers carry one of these
+    result_ready = Signal(str) # Full AI text response, emitted once the turn is complete
+    chunk_ready = Signal(str) # Streamed piece of the AI response as it is generated
     error_occurred = Signal(str)
+    session_reset = Signal(object) # New ChatSession after older history was summarized
+    question_embedded = Signal(object) # Embedding of a question the semantic cache missed, for storing with its answer
     # progress_update = Signal(str) # Less critical in simple chat
 
-    # Takes the chat session and the new user message text
-    def __init__(self, chat_session: Optional[ChatSession], user_message_text: str, doc_ref: Optional[File]):
+class AIChatWorker(QRunnable):
+    # Takes the chat session and the new user message text. One instance is reused for every turn:
+    # prepare_turn() loads the next turn, and auto-delete is off so the pool can run it again.
+    def __init__(self, chat_session: Optional[ChatSession] = None, user_message_text: str = "", doc_ref: Optional[File] = None,
+                 is_initial_turn: bool = False, system_prompt: Optional[str] = None, history_limit: int = 0,
+                 max_history_tokens: int = MAX_HISTORY_TOKENS, cancel_event: Optional[threading.Event] = None):
         super().__init__()
+        self.setAutoDelete(False)
+        self.signals = _ChatSignals() # Created on the GUI thread, so emits are queued to it
+        self.max_history_tokens = max_history_tokens # Drop older turns past this estimated size (0 = never)
+        self._idle = threading.Event() # Set whenever no turn is queued or running
+        self._cancel = cancel_event or threading.Event() # Shared with the app and never cleared: set on close, ends every turn
+        self.prepare_turn(chat_session, user_message_text, doc_ref, is_initial_turn, system_prompt, history_limit)
+        self._idle.set() # Not submitted yet
+
+    def prepare_turn(self, chat_session: Optional[ChatSession], user_message_text: str, doc_ref: Optional[File],
+                     is_initial_turn: bool = False, system_prompt: Optional[str] = None, history_limit: int = 0,
+                     context_cache: Optional[Any] = None, base_model: Optional[GenerativeModel] = None,
+                     semantic_lookup: Optional[Tuple[Any, Optional[Tuple[Any, List[str], List[int]]], int]] = None):
+        """Sets up the next turn. Call only while idle (see is_idle), right before submitting to the pool."""
         self.chat_session = chat_session
         self.user_message_text = user_message_text
-        self.doc_ref = doc_ref # Pass doc reference if needed (e.g., for sending files with message)
+        self.doc_ref = doc_ref # Sent only with the first turn (and summary seed), then lives in session history
+        self.is_initial_turn = is_initial_turn
+        self.system_prompt = system_prompt # Frozen at session creation, sent as its own part
+        self.history_limit = history_limit # Summarize older messages past this many (0 = never)
+        self.context_cache = context_cache # CachedContent the session's model reads document + prompt from, if any
+        self.base_model = base_model # Plain model to continue on if that cache is gone
+        self.semantic_lookup = semantic_lookup # (embedder, semantic cache entry, conversation id) to try before asking the AI
         self._is_running = True
+        self._idle.clear()
+
+    def is_idle(self) -> bool:
+        """True once the previous turn's run() has returned (its results are emitted just before)."""
+        return self._idle.is_set()
 
-    @Slot()
     def run(self):
-        if not self._is_running: return
+        try: self._run()
+        finally: self._idle.set()
+
+    def _cancelled(self) -> bool:
+        """True once this turn was stopped or the app is shutting down."""
+        return not self._is_running or self._cancel.is_set()
+
+    def _run(self):
+        if self._cancelled(): return
+        if not _ensure_genai():
+            self.signals.error_occurred.emit("Google AI library not installed.")
+            return
         if not self.chat_session:
-            self.error_occurred.emit("AI Chat session not initialized.")
+            self.signals.error_occurred.emit("AI Chat session not initialized.")
             return
 
+        response = None # Set once the turn is part of the session; a turn that doesn't finish cleanly is rewound
         try:
-            print(f"Sending to AI: {self.user_message_text[:100]}...")
-            # Construct the message content - can include files if needed
-            # For Flash, sending the file with *every* message might be inefficient.
-            # Better to rely on the File API URI being processed initially.
-            # Check Gemini API docs for best practices with File API + Chat.
-            # Assuming file is processed and AI can access via URI implicitly:
-            message_content = [self.user_message_text]
-            # Example if sending file explicitly is needed:
-            # if self.doc_ref: message_content.append(self.doc_ref)
-
-            # Send message using the existing chat session
-            response = self.chat_session.send_message(message_content)
-
-            if not self._is_running: return # Check if stopped during API call
-
-            response_text = response.text # Simplified access for chat
-            print(f"AI Response: {response_text[:200]}...")
-            if self._is_running:
-                self.result_ready.emit(response_text)
+            if self.context_cache is not None: self._keep_context_cache_alive()
+            if self.history_limit and len(self.chat_session.history) > self.history_limit:
+                self._summarize_old_history()
+                if self._cancelled(): return
+            if self.max_history_tokens and _estimate_tokens(self.chat_session.history) > self.max_history_tokens:
+                self._trim_history_to_budget()
+
+            if self.semantic_lookup is not None:
+                cached_answer = self._answer_from_semantic_cache()
+                if cached_answer is not None:
+                    log.debug("Reusing the answer to a similar earlier question.")
+                    # Record the turn in the session too, exactly as it would have been sent
+                    self.chat_session.history = [*self.chat_session.history,
+                                                 {'role': ROLE_USER, 'parts': [self.user_message_text]}, {'role': ROLE_AI, 'parts': [cached_answer]}]
+                    if not self._cancelled(): self.signals.result_ready.emit(cached_answer)
+                    return
+
+            log.debug("Sending to AI: %s...", self.user_message_text[:100])
+            # The document and system prompt are attached only to the first turn. After that they
+            # are part of the session history, so later turns send just the new text and the
+            # history prefix stays byte-identical for Gemini's prompt cache.
+            if self.is_initial_turn:
+                message_content = [p for p in (*self._context_parts(), self.user_message_text) if p]
+            else:
+                message_content = [self.user_message_text]
+
+            # Send message using the existing chat session, streaming the answer as it is generated
+            response = self.chat_session.send_message(message_content, stream=True)
+
+            # Text is read straight from the candidate parts once per chunk and joined once at the
+            # end; the .text property re-walks candidates and raises on chunks without text parts.
+            response_parts: List[str] = []
+            for chunk in response:
+                if self._cancelled(): # Stopped or closing: leave at the next chunk boundary
+                    self._rewind_unfinished_turn(response); return
+                chunk_text = ''.join(part.text for candidate in chunk.candidates[:1] for part in candidate.content.parts)
+                if chunk_text:
+                    response_parts.append(chunk_text)
+                    self.signals.chunk_ready.emit(chunk_text)
+
+            if not response_parts: # e.g. blocked by safety filters
+                raise ValueError(f"AI returned no text. Feedback: {response.prompt_feedback}")
+            finish_reason = response.candidates[0].finish_reason.name # Streaming defers the SDK's own check to here
+            if finish_reason not in CLEAN_FINISH_REASONS:
+                raise ValueError(f"AI stopped the answer early ({finish_reason}).")
+            if not self._cancelled():
+                self.signals.result_ready.emit(''.join(response_parts))
 
         except (google.api_core.exceptions.GoogleAPIError, ConnectionError, ValueError) as e:
-            print(f"Error in AI Chat Worker: {e}")
-            if self._is_running: self.error_occurred.emit(f"AI Error: {e}")
+            log.error("Error in AI Chat Worker: %s", e)
+            self._rewind_unfinished_turn(response) # Before reporting, so the next turn sees a clean session
+            if self._is_running: self.signals.error_occurred.emit(f"AI Error: {e}")
+        except Exception as e:
+            log.exception("Unexpected Error in AI Chat Worker")
+            self._rewind_unfinished_turn(response)
+            if self._is_running: self.signals.error_occurred.emit(f"Unexpected Error: {e}")
+
+    def _rewind_unfinished_turn(self, response):
+        """Drops the last turn if its answer didn't finish cleanly. The session would otherwise keep it
+        as its last response, and every later read of its history raises BrokenResponseError."""
+        if response is None: return # send_message failed, the session is unchanged
+        try: self.chat_session.rewind()
+        except Exception as e: log.warning("Could not rewind the failed chat turn: %s", e)
+
+    def _summarize_old_history(self):
+        """Replaces older turns with a summary: the session restarts as [doc + prompt + summary, *recent turns]."""
+        history = self.chat_session.history
+        keep = max(2, self.history_limit // 4 * 2) # Even count, so the recent slice starts with a user turn
+        old_turns, recent_turns = history[:-keep], history[-keep:]
+        log.debug("Chat history has %d messages, summarizing the oldest %d...", len(history), len(old_turns))
+
+        # Serialize text only; the document and the (unchanging) system prompt are re-attached below
+        transcript_lines = []
+        for content in old_turns:
+            speaker = "Student" if content.role == ROLE_USER else "Tutor"
+            for part in content.parts:
+                part_text = getattr(part, 'text', '')
+                if part_text and part_text != self.system_prompt:
+                    transcript_lines.append(f"{speaker}: {part_text}")
+        summary_text = self.chat_session.model.generate_content(f"{SUMMARY_REQUEST}\n\n" + "\n".join(transcript_lines)).text
+
+        seed_parts = [p for p in (*self._context_parts(), f"Summary of our conversation so far:\n{summary_text}") if p]
+        self.chat_session = self.chat_session.model.start_chat(history=[
+            {'role': ROLE_USER, 'parts': seed_parts},
+            {'role': ROLE_AI, 'parts': ["Understood. Let's continue."]},
+            *recent_turns,
+        ])
+        if self._is_running: self.signals.session_reset.emit(self.chat_session)
+
+    def _answer_from_semantic_cache(self) -> Optional[str]:
+        """Embeds the question (here, off the GUI thread) and returns the answer to a very similar question from
+        another conversation, if any. On a miss the embedding is handed back so the answer can be stored with it."""
+        embedder, entry, conversation_id = self.semantic_lookup
+        try:
+            embedding = embedder.encode([self.user_message_text], normalize_embeddings=True)[0]
         except Exception as e:
-            print(f"Unexpected Error in AI Chat Worker: {e}"); import traceback; traceback.print_exc()
-            if self._is_running: self.error_occurred.emit(f"Unexpected Error: {e}")
+            log.warning("Semantic cache skipped, could not embed the question: %s", e); return None
+        if entry is not None:
+            embeddings, answers, conversation_ids = entry
+            similarities = embeddings @ embedding # Cosine similarity, the embeddings are normalized
+            similarities[[i for i, cid in enumerate(conversation_ids) if cid == conversation_id]] = -1.0 # Same conversation: follow-ups depend on its context
+            best = int(similarities.argmax())
+            if similarities[best] > SEMANTIC_CACHE_THRESHOLD: return answers[best]
+        self.signals.question_embedded.emit(embedding)
+        return None
+
+    def _context_parts(self) -> Tuple[Any, ...]:
+        """Document + system prompt to send, unless the session's model already has them in its context cache."""
+        return () if self.context_cache is not None else (self.doc_ref, self.system_prompt)
+
+    def _keep_context_cache_alive(self):
+        """Extends the context cache when it is close to expiring. If it is already gone, the conversation
+        moves to the plain model with the document + prompt re-attached in front of the history."""
+        if self.context_cache.expire_time - datetime.datetime.now(datetime.timezone.utc) >= CONTEXT_CACHE_REUSE_MARGIN: return
+        try:
+            self.context_cache.update(ttl=CONTEXT_CACHE_TTL); return
+        except Exception as e:
+            log.warning("Context cache no longer usable, continuing without it: %s", e)
+        self.context_cache = None
+        self.chat_session = self.base_model.start_chat(history=[
+            {'role': ROLE_USER, 'parts': [p for p in self._context_parts() if p]},
+            {'role': ROLE_AI, 'parts': ["Understood. Let's continue."]},
+            *self.chat_session.history,
+        ])
+        if self._is_running: self.signals.session_reset.emit(self.chat_session)
+
+    def _trim_history_to_budget(self):
+        """Restarts the session as [first exchange (document + prompt), *newest turns within the token budget]."""
+        history = self.chat_session.history
+        pinned, rest = history[:2], history[2:] # The opening exchange carries the document context
+        budget = self.max_history_tokens - _estimate_tokens(pinned)
+        keep = used = 0
+        for start in range(len(rest) - 2, -1, -2): # Whole user/AI exchanges, newest first, so the kept slice starts with a user turn
+            used += _estimate_tokens(rest[start:start + 2])
+            if used > budget: break
+            keep += 2
+        log.debug("Chat history over %d estimated tokens, keeping the first and last %d of %d messages.",
+                  self.max_history_tokens, keep, len(history))
+        self.chat_session = self.chat_session.model.start_chat(history=[*pinned, *rest[len(rest) - keep:]])
+        if self._is_running: self.signals.session_reset.emit(self.chat_session)
 
     def stop(self):
-        print("AIChatWorker stop() called.")
+        log.debug("AIChatWorker stop() called.")
         self._is_running = False
 
-class PDFUploadWorker(QObject):
-    # (Largely unchanged - Keep robust error handling & progress reporting)
+@functools.lru_cache(maxsize=None)
+def _model_supports_context_cache(model_name: str) -> bool:
+    """Whether the model can hold a CachedContent (aliases like '-latest' can't). Looked up once per model;
+    a failed lookup raises, so it is not cached and is retried next time."""
+    return 'createCachedContent' in genai.get_model(model_name).supported_generation_methods
+
+class _ChatInitSignals(QObject):
+    session_ready = Signal(str, object, object) # (document basename, new ChatSession, CachedContent holding document + prompt, or None)
+    error_occurred = Signal(str)
+
+class ChatInitWorker(QRunnable):
+    """Creates a ChatSession in the pool; start_chat may do network setup on some backends.
+    If the model supports context caching, the document and system prompt are cached server-side first
+    (or an earlier cache of them is reused), so no turn has to re-send them."""
+    def __init__(self, model: GenerativeModel, doc_basename: str, doc_ref: Optional[File] = None,
+                 system_prompt: Optional[str] = None, model_options: Optional[Dict[str, Any]] = None,
+                 context_cache: Optional[Any] = None, try_caching: bool = True):
+        super().__init__(); self.signals = _ChatInitSignals(); self.model = model; self.doc_basename = doc_basename; self._is_running = True
+        self.doc_ref = doc_ref; self.system_prompt = system_prompt
+        self.model_options = model_options or {} # generation_config/safety_settings for a model built from the cache
+        self.context_cache = context_cache # CachedContent made earlier for the same model, document and prompt
+        self.try_caching = try_caching # False if creating a cache for these failed before
+
+    def run(self):
+        try:
+            cached_model, cached_content = self._cached_context_model() if self.doc_ref is not None else (None, None)
+            chat_session = (cached_model or self.model).start_chat(history=[])
+            if self._is_running: self.signals.session_ready.emit(self.doc_basename, chat_session, cached_content)
+        except Exception as e:
+            log.exception("Failed to start chat session")
+            if self._is_running: self.signals.error_occurred.emit(str(e))
+
+    def _cached_context_model(self) -> Tuple[Optional[GenerativeModel], Optional[Any]]:
+        """Returns (model whose context already holds the document + system prompt, its CachedContent),
+        or (None, None) if caching isn't possible."""
+        caching = getattr(genai, 'caching', None)
+        if caching is None or not self.try_caching: return None, None # SDK without the CachedContent API, or known to fail
+        try:
+            cached_content = self.context_cache
+            if cached_content is None or cached_content.expire_time - datetime.datetime.now(datetime.timezone.utc) < CONTEXT_CACHE_REUSE_MARGIN:
+                if not _model_supports_context_cache(self.model.model_name): return None, None
+                cached_content = caching.CachedContent.create(
+                    model=self.model.model_name, display_name=self.doc_basename, ttl=CONTEXT_CACHE_TTL,
+                    contents=[{'role': ROLE_USER, 'parts': [p for p in (self.doc_ref, self.system_prompt) if p]}])
+            return GenerativeModel.from_cached_content(cached_content, **self.model_options), cached_content
+        except Exception as e: # e.g. document below the minimum cacheable size
+            log.debug("Context caching not used for '%s': %s", self.doc_basename, e)
+            return None, None
+
+    def stop(self):
+        log.debug("ChatInitWorker stop() called."); self._is_running = False
+
+class _UploadSignals(QObject):
     finished = Signal(list) # List[File]
     error_occurred = Signal(str)
     progress_update = Signal(str) # Filename being processed
     file_processed = Signal(str) # Filename successfully processed by backend
+    file_hashed = Signal(str, str) # (filename, sha256 of the uploaded content)
 
-    def __init__(self, file_paths: List[str], basenames: List[str]):
-        super().__init__(); self.file_paths = file_paths; self.basenames = basenames; self._is_running = True
+class PDFUploadWorker(QRunnable):
+    # (Largely unchanged - Keep robust error handling & progress reporting)
+    def __init__(self, file_paths: List[str], basenames: List[str], upload_cache: Optional[FileUploadCache] = None):
+        super().__init__(); self.signals = _UploadSignals(); self.file_paths = file_paths; self.basenames = basenames; self._is_running = True
+        self.upload_cache = upload_cache
+        self._cache_keys: Dict[str, str] = {} # {filename: sha256 of its content}
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._stop_event = threading.Event() # Set by stop() to wake the poll wait immediately
 
-    @Slot()
     def run(self):
-        if not self._is_running: self.error_occurred.emit("Upload stopped."); return
+        if not self._is_running: self.signals.error_occurred.emit("Upload stopped."); return
+        if not _ensure_genai(): self.signals.error_occurred.emit("Google AI library not installed."); return
         temp_uploaded_references: List[File] = []
+        in_flight: List[Tuple[str, File]] = [] # (filename, File) uploaded but not yet ACTIVE
         try:
-            print("Starting File API Upload..."); time.sleep(0.1)
-            for i, file_path in enumerate(self.file_paths):
-                if not self._is_running: print(f"UploadWorker: Stopping before processing idx {i}."); break
-                filename = self.basenames[i]
-                print(f"-> Uploading {filename} ({i+1}/{len(self.file_paths)})...")
-                self.progress_update.emit(f"Uploading {filename}...")
-
-                mime_type, _ = mimetypes.guess_type(file_path)
-                if not mime_type: mime_type = 'application/octet-stream' # Fallback
-                print(f"   MIME Type: {mime_type}")
-
-                # Check if file still exists right before upload
-                if not os.path.exists(file_path):
-                    raise FileNotFoundError(f"File disappeared before upload: {filename}")
-
-                uploaded_file = genai.upload_file(path=file_path, display_name=filename, mime_type=mime_type)
-                if not self._is_running: break # Check immediately after upload call starts
-
-                print(f"   '{filename}' upload initiated, waiting for processing...")
-                self.progress_update.emit(f"Processing {filename}...")
-
-                # --- File Processing Wait Loop ---
-                start_time = time.time()
-                wait_time = 5 # Initial wait
-                max_wait = 120 # Max wait 2 minutes per file
-                while time.time() - start_time < max_wait:
+            log.debug("Starting File API Upload..."); time.sleep(0.1)
+            # --- Phase 1: Upload files concurrently, without waiting for backend processing ---
+            max_workers = max(1, min(MAX_PARALLEL_UPLOADS, len(self.file_paths)))
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+            try:
+                futures = {self._executor.submit(self._upload_one, path, name): name
+                           for path, name in zip(self.file_paths, self.basenames)}
+                for future in concurrent.futures.as_completed(futures):
+                    if not self._is_running: log.debug("UploadWorker: Stopping during uploads."); break
+                    filename = futures[future]
+                    uploaded_file = future.result() # Re-raises upload errors
+                    if uploaded_file.state.name == 'ACTIVE': # Cache hit (or instant processing), no wait needed
+                        self._mark_processed(filename, uploaded_file, temp_uploaded_references)
+                        continue
+                    in_flight.append((filename, uploaded_file))
+                    log.debug("   '%s' upload initiated.", filename)
+            finally:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+
+            # --- Phase 2: Poll all in-flight files, one wait per sweep (not per file) ---
+            if in_flight and self._is_running:
+                self.signals.progress_update.emit(f"Processing {len(in_flight)} file(s)...")
+            start_time = time.time()
+            wait_time = 5 # Initial wait
+            max_wait = 120 # Max wait 2 minutes after the last upload was submitted
+            while in_flight and self._is_running:
+                if time.time() - start_time >= max_wait:
+                    for filename, uploaded_file in in_flight:
+                        log.error("Timeout waiting for '%s' to become ACTIVE.", filename)
+                        self._discard_remote_file(filename, uploaded_file, "timed-out")
+                    break
+
+                still_processing: List[Tuple[str, File]] = []
+                for filename, uploaded_file in in_flight:
                     if not self._is_running: break # Check if stopped
-
                     try:
                         uploaded_file = genai.get_file(uploaded_file.name)
                     except Exception as get_err:
-                        print(f"   Error checking file status for {filename}: {get_err}. Retrying in {wait_time}s...")
-                        # Add exponential backoff? For now, just fixed wait.
-                        time.sleep(wait_time); continue # Retry get_file
+                        log.warning("Error checking file status for %s: %s. Retrying next sweep...", filename, get_err)
+                        still_processing.append((filename, uploaded_file)); continue
 
                     state = uploaded_file.state.name
-                    print(f"   '{filename}' state: {state} (Elapsed: {time.time() - start_time:.1f}s)")
+                    log.debug("   '%s' state: %s (Elapsed: %.1fs)", filename, state, time.time() - start_time)
 
                     if state == 'ACTIVE':
-                        self.file_processed.emit(filename)
-                        temp_uploaded_references.append(uploaded_file)
-                        print(f"<- Processed '{filename}'. URI: {uploaded_file.uri}")
-                        break # Success for this file
-                    elif state == 'FAILED':
-                         print(f"Error: '{filename}' failed processing. State: {state}")
-                         # Attempt deletion of failed file
-                         try: genai.delete_file(uploaded_file.name)
-                         except Exception as del_e: print(f"   Warning: Failed to delete failed file '{filename}': {del_e}")
-                         raise google.api_core.exceptions.GoogleAPIError(f"File processing failed for '{filename}': State={state}")
+                        self._mark_processed(filename, uploaded_file, temp_uploaded_references)
                     elif state == 'PROCESSING':
-                        if not self._is_running: break # Check again before sleep
-                        time.sleep(wait_time)
-                        wait_time = min(wait_time * 1.5, 15) # Increase wait time slightly
-                    else: # Should not happen (e.g., DELETED?)
-                         print(f"Error: Unexpected file state '{state}' for '{filename}'.")
-                         raise google.api_core.exceptions.GoogleAPIError(f"Unexpected state for '{filename}': {state}")
-
-                else: # Loop finished due to timeout
-                     print(f"Error: Timeout waiting for '{filename}' to become ACTIVE.")
-                     # Attempt deletion of timed-out file
-                     try: genai.delete_file(uploaded_file.name)
-                     except Exception as del_e: print(f"   Warning: Failed to delete timed-out file '{filename}': {del_e}")
-                     raise TimeoutError(f"Timeout processing file '{filename}'")
-
-                if not self._is_running: break # Exit outer loop if stopped
+                        still_processing.append((filename, uploaded_file))
+                    else: # FAILED, or unexpected (e.g., DELETED?) - drop it, keep polling the rest
+                        log.error("'%s' failed processing. State: %s", filename, state)
+                        self._discard_remote_file(filename, uploaded_file, "failed")
+
+                in_flight = still_processing
+                if in_flight and self._is_running:
+                    if self._stop_event.wait(wait_time): break # Woken early by stop()
+                    wait_time = min(wait_time * 1.5, 15) # Increase wait time slightly
 
             # --- Loop Finished ---
+            if self.upload_cache: self.upload_cache.save()
             if self._is_running:
                  # Check if all requested files were processed successfully
                  if len(temp_uploaded_references) == len(self.file_paths):
-                     print(f"File Upload finished. Emitting {len(temp_uploaded_references)} references.");
-                     self.finished.emit(temp_uploaded_references)
+                     log.debug("File Upload finished. Emitting %d references.", len(temp_uploaded_references))
+                     self.signals.finished.emit(temp_uploaded_references)
                  else:
                      # Some files might have failed, or the process was stopped
                      failed_count = len(self.file_paths) - len(temp_uploaded_references)
-                     print(f"Upload finished, but {failed_count} files were not successfully processed.")
+                     log.warning("Upload finished, but %d files were not successfully processed.", failed_count)
                      # Decide whether to emit partial list or error? Let's emit partial for now.
-                     self.finished.emit(temp_uploaded_references) # Emit refs for successful ones
+                     self.signals.finished.emit(temp_uploaded_references) # Emit refs for successful ones
                      # Error handling/reporting should happen in the main thread based on this partial list
             else:
-                 print("Upload process was stopped. Not emitting 'finished'.")
+                 log.debug("Upload process was stopped. Not emitting 'finished'.")
                  # Clean up files uploaded before stop, if desired (optional, requires tracking)
                  # Example: self._cleanup_files(temp_uploaded_references)
 
         except (google.api_core.exceptions.GoogleAPIError, FileNotFoundError, TimeoutError, ValueError) as e:
-             print(f"Error during File Upload: {e}"); self.error_occurred.emit(f"Upload Error: {e}")
+             log.error("Error during File Upload: %s", e); self.signals.error_occurred.emit(f"Upload Error: {e}")
         except Exception as e:
-             print(f"Unexpected Error in PDF Upload: {e}"); self.error_occurred.emit(f"Unexpected Upload Error: {e}")
+             log.exception("Unexpected Error in PDF Upload"); self.signals.error_occurred.emit(f"Unexpected Upload Error: {e}")
+
+    def _upload_one(self, file_path: str, filename: str) -> File:
+        """Uploads a single file; runs on the upload executor."""
+        log.debug("-> Uploading %s...", filename)
+        self.signals.progress_update.emit(f"Uploading {filename}...")
+
+        mime_type = MIME_BY_EXT.get(os.path.splitext(file_path)[1].lower(), 'application/octet-stream') # Fallback
+        log.debug("   MIME Type: %s", mime_type)
+
+        # Check if file still exists right before upload
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"File disappeared before upload: {filename}")
+
+        try: sha256 = _file_sha256(file_path)
+        except OSError as e: log.warning("Could not hash '%s': %s", filename, e); sha256 = None
+        if sha256:
+            self._cache_keys[filename] = sha256
+            self.signals.file_hashed.emit(filename, sha256) # Lets the handle be reused next launch
+            cached_file = self._lookup_cached_upload(sha256, filename)
+            if cached_file: return cached_file
+
+        return genai.upload_file(path=file_path, display_name=filename, mime_type=mime_type)
+
+    def _mark_processed(self, filename: str, uploaded_file: File, references: List[File]):
+        """Records a file that reached ACTIVE and remembers it in the upload cache."""
+        self.signals.file_processed.emit(filename)
+        references.append(uploaded_file)
+        if self.upload_cache and filename in self._cache_keys:
+            self.upload_cache.put(self._cache_keys[filename], uploaded_file)
+        log.debug("<- Processed '%s'. URI: %s", filename, uploaded_file.uri)
+
+    def _lookup_cached_upload(self, sha256: str, filename: str) -> Optional[File]:
+        """Returns the previously uploaded File for identical content if it is still ACTIVE on the backend."""
+        return _fetch_cached_upload(self.upload_cache, sha256, filename) if self.upload_cache else None
+
+    def _discard_remote_file(self, filename: str, uploaded_file: File, reason: str):
+        """Best-effort deletion of a backend file that will not be used."""
+        try: genai.delete_file(uploaded_file.name)
+        except Exception as del_e: log.warning("Failed to delete %s file '%s': %s", reason, filename, del_e)
+
+    def stop(self):
+        log.debug("PDFUploadWorker stop() called."); self._is_running = False
+        self._stop_event.set()
+        if self._executor: self._executor.shutdown(wait=False, cancel_futures=True) # Drop queued uploads
+
+def _fetch_cached_upload(upload_cache: FileUploadCache, sha256: str, basename: str) -> Optional[File]:
+    """Looks the content up in the upload cache and returns its File if it is still ACTIVE on the backend."""
+    file_id = upload_cache.get(sha256, basename)
+    if not file_id: return None
+    try:
+        cached_file = genai.get_file(file_id)
+    except Exception as get_err: # Expired or deleted on the backend
+        log.debug("   Cached upload for '%s' no longer available: %s", basename, get_err)
+        upload_cache.discard(sha256); return None
+    if cached_file.state.name != 'ACTIVE' or cached_file.display_name != basename:
+        upload_cache.discard(sha256); return None
+    log.debug("<- Reusing cached upload for '%s'. URI: %s", basename, cached_file.uri)
+    return cached_file
+
+class _RehydrateSignals(QObject):
+    finished = Signal(list) # List[(File, sha256)] still ACTIVE and matching the local file
+
+class UploadRehydrateWorker(QRunnable):
+    """Finds earlier uploads of local files (handles saved in the config, then the content-hash
+    upload cache), so unchanged files need no re-upload."""
+    def __init__(self, file_paths: Dict[str, str], handles: Dict[str, Dict[str, str]], upload_cache: Optional[FileUploadCache] = None):
+        super().__init__(); self.signals = _RehydrateSignals(); self.file_paths = file_paths; self.handles = handles; self._is_running = True
+        self.upload_cache = upload_cache
+
+    def run(self):
+        restored: List[Tuple[File, str]] = []
+        if not _ensure_genai(): self.signals.finished.emit(restored); return
+        for basename, path in self.file_paths.items():
+            if not self._is_running: return
+            try: sha256 = _file_sha256(path)
+            except OSError as e: log.debug("Cannot hash '%s': %s", basename, e); continue # Local file gone
+            file_obj = self._fetch_saved_handle(basename, sha256)
+            if file_obj is None and self.upload_cache:
+                file_obj = _fetch_cached_upload(self.upload_cache, sha256, basename)
+            if file_obj is not None: restored.append((file_obj, sha256))
+        if self.upload_cache: self.upload_cache.save() # Persist discarded stale entries
+        if self._is_running: self.signals.finished.emit(restored)
+
+    def _fetch_saved_handle(self, basename: str, sha256: str) -> Optional[File]:
+        handle = self.handles.get(basename)
+        if not handle: return None
+        if handle.get('sha256') != sha256:
+            log.debug("'%s' changed since it was uploaded, not reusing its handle.", basename); return None
+        try: file_obj = genai.get_file(handle['name'])
+        except Exception as e: # Remote file expired/deleted
+            log.debug("Saved upload for '%s' not reusable: %s", basename, e); return None
+        return file_obj if file_obj.state.name == 'ACTIVE' and file_obj.display_name == basename else None
 
     def stop(self):
-        print("PDFUploadWorker stop() called."); self._is_running = False
+        log.debug("UploadRehydrateWorker stop() called."); self._is_running = False
+
+class _ConfigSaveSignals(QObject):
+    saved = Signal(object) # Upload handles the written file contains
+    failed = Signal(str)
+
+class ConfigSaveWorker(QRunnable):
+    """Writes an already rendered config file (and the upload cache) off the GUI thread."""
+    def __init__(self, path: str, text: str, upload_handles: Dict[str, Dict[str, str]], upload_cache: Optional[FileUploadCache] = None):
+        super().__init__(); self.signals = _ConfigSaveSignals(); self.path = path; self.text = text
+        self.upload_handles = upload_handles; self.upload_cache = upload_cache
+
+    def run(self):
+        try:
+            _write_file_atomic(self.path, self.text)
+            if self.upload_cache: self.upload_cache.save() # No-op unless a worker changed it without saving
+            self.signals.saved.emit(self.upload_handles)
+        except OSError as e:
+            self.signals.failed.emit(str(e))
+
+class _GenaiImportSignals(QObject):
+    finished = Signal(bool) # True if the SDK could be imported
+
+class GenaiImportWorker(QRunnable):
+    """Imports the Gemini SDK (protobuf + gRPC, a noticeable pause) off the GUI thread."""
+    def __init__(self):
+        super().__init__(); self.signals = _GenaiImportSignals()
+
+    def run(self):
+        self.signals.finished.emit(_ensure_genai())
+
+class _EmbedderSignals(QObject):
+    loaded = Signal(object) # SentenceTransformer, or None if it could not be loaded
+
+class EmbedderLoadWorker(QRunnable):
+    """Loads the sentence embedding model for the semantic response cache off the GUI thread."""
+    def __init__(self):
+        super().__init__(); self.signals = _EmbedderSignals()
+
+    def run(self):
+        try:
+            from sentence_transformers import SentenceTransformer
+            embedder = SentenceTransformer(SEMANTIC_CACHE_MODEL)
+        except Exception as e:
+            log.warning("Could not load semantic cache model '%s': %s", SEMANTIC_CACHE_MODEL, e); embedder = None
+        self.signals.loaded.emit(embedder)
+
+class _DeleteSignals(QObject):
+    finished = Signal(int, int) # (deleted_count, failed_count)
+
+class BackendDeleteWorker(QRunnable):
+    """Deletes files from the Gemini backend off the GUI thread, several requests at a time."""
+    def __init__(self, file_api_objects: List[File]):
+        super().__init__(); self.signals = _DeleteSignals(); self.file_api_objects = file_api_objects
+
+    def run(self):
+        deleted_count = 0
+        failed_count = 0
+        max_workers = max(1, min(MAX_PARALLEL_DELETES, len(self.file_api_objects)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(genai.delete_file, file_obj.name): file_obj for file_obj in self.file_api_objects}
+            for future in concurrent.futures.as_completed(futures):
+                file_obj = futures[future]
+                label = getattr(file_obj, 'display_name', file_obj.name)
+                try:
+                    future.result()
+                    log.debug("Deleted '%s' from backend.", label)
+                    deleted_count += 1
+                except Exception as e:
+                    log.warning("Failed deleting '%s': %s", label, e)
+                    failed_count += 1
+        self.signals.finished.emit(deleted_count, failed_count)
+
+class ContextCacheDeleteWorker(QRunnable):
+    """Deletes server-side context caches that no chat session will use again (best effort, nothing reported back)."""
+    def __init__(self, cached_contents: List[Any]):
+        super().__init__(); self.cached_contents = cached_contents
+
+    def run(self):
+        for cached_content in self.cached_contents:
+            try: cached_content.delete()
+            except Exception as e: log.warning("Failed deleting context cache '%s': %s", getattr(cached_content, 'name', '?'), e)
 
 # ==================================
 # Settings Widget (Simplified)
@@ -234,7 +837,7 @@ class SettingsWidget(QWidget):
         top_layout.addStretch()
         layout.addLayout(top_layout)
 
-        title_label = QLabel("⚙️ Settings"); title_font = QFont(FONT_FAMILY, 16, QFont.Weight.Bold); title_label.setFont(title_font); title_label.setAlignment(Qt.AlignmentFlag.AlignCenter); layout.addWidget(title_label)
+        title_label = QLabel("⚙️ Settings"); title_label.setFont(_bold_font(16)); title_label.setAlignment(Qt.AlignmentFlag.AlignCenter); layout.addWidget(title_label)
 
         # --- AI Config ---
         ai_groupbox = QGroupBox("🤖 AI Configuration")
@@ -247,12 +850,20 @@ class SettingsWidget(QWidget):
         ai_layout.addRow("Tutor Language:", self.language_combo)
         self.temperature_spinbox = QDoubleSpinBox(); self.temperature_spinbox.setRange(0.0, 1.0); self.temperature_spinbox.setSingleStep(0.1); self.temperature_spinbox.setValue(DEFAULT_TEMPERATURE); self.temperature_spinbox.setToolTip("Controls randomness (0=deterministic, 1=more creative)")
         ai_layout.addRow("AI Temperature:", self.temperature_spinbox)
+        self.history_limit_spinbox = QSpinBox(); self.history_limit_spinbox.setRange(10, 200); self.history_limit_spinbox.setSingleStep(10); self.history_limit_spinbox.setValue(DEFAULT_HISTORY_LIMIT); self.history_limit_spinbox.setSuffix(" messages"); self.history_limit_spinbox.setToolTip("Older chat messages beyond this are summarized to keep each turn fast and cheap")
+        ai_layout.addRow("Summarize History After:", self.history_limit_spinbox)
+        self.semantic_cache_checkbox = QCheckBox("Reuse answers to similar questions")
+        self.semantic_cache_checkbox.setToolTip("Answers a question from an earlier, very similar one without asking the AI.\nCached answers are shared across chat sessions on this computer." if semantic_cache_available
+                                                else "Requires the 'sentence-transformers' package.")
+        self.semantic_cache_checkbox.setEnabled(semantic_cache_available)
+        ai_layout.addRow("Semantic Cache:", self.semantic_cache_checkbox)
         layout.addWidget(ai_groupbox)
 
         # --- Course Material ---
         pdf_groupbox = QGroupBox("📚 Course Material (PDF, MD)")
         pdf_layout = QVBoxLayout(pdf_groupbox)
         self.pdf_list_widget = QListWidget(); self.pdf_list_widget.setSelectionMode(QListWidget.SelectionMode.ExtendedSelection)
+        self._shown_files: Tuple[str, ...] = () # What pdf_list_widget currently lists, in order
         pdf_layout.addWidget(self.pdf_list_widget)
         pdf_button_layout = QHBoxLayout(); pdf_button_layout.setSpacing(5)
         self.add_files_button = QPushButton("➕ Add File(s)")
@@ -291,20 +902,43 @@ class SettingsWidget(QWidget):
 
     def _request_clear_files(self):
         if self.pdf_list_widget.count() > 0:
-             reply = QMessageBox.question(self, "Confirm Clear", "Remove all files from the list?\n(Uploaded files will also be deleted from the AI backend if possible).", QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No, QMessageBox.StandardButton.No);
-             if reply == QMessageBox.StandardButton.Yes: self.files_cleared.emit()
+             # Window-modal and opened asynchronously, so the event loop keeps running while the user decides
+             confirm_box = QMessageBox(self)
+             confirm_box.setIcon(QMessageBox.Icon.Question)
+             confirm_box.setWindowTitle("Confirm Clear")
+             confirm_box.setText("Remove all files from the list?\n(Uploaded files will also be deleted from the AI backend if possible).")
+             confirm_box.setStandardButtons(QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
+             confirm_box.setDefaultButton(QMessageBox.StandardButton.No)
+             confirm_box.setWindowModality(Qt.WindowModality.WindowModal)
+             confirm_box.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
+             confirm_box.buttonClicked.connect(lambda button: self._on_clear_confirmed(confirm_box.standardButton(button)))
+             confirm_box.open()
         else: QMessageBox.information(self, "Info", "File list is already empty.")
 
-    def update_file_list(self, basenames: List[str]):
-        self.pdf_list_widget.clear()
-        self.pdf_list_widget.addItems(basenames)
+    def _on_clear_confirmed(self, clicked: QMessageBox.StandardButton):
+        if clicked == QMessageBox.StandardButton.Yes: self.files_cleared.emit()
+
+    def update_file_list(self, basenames: Iterable[str]):
+        """Shows the given files, touching only rows that were added or removed since the last call."""
+        new_files = tuple(basenames)
+        if new_files == self._shown_files: return # Most calls: nothing changed
+        shown = set(self._shown_files); removed = shown.difference(new_files)
+        self.pdf_list_widget.setUpdatesEnabled(False) # One relayout for the whole refresh
+        if removed:
+            for row in range(self.pdf_list_widget.count() - 1, -1, -1):
+                if self.pdf_list_widget.item(row).text() in removed: self.pdf_list_widget.takeItem(row)
+        self.pdf_list_widget.addItems([b for b in new_files if b not in shown])
+        self.pdf_list_widget.setUpdatesEnabled(True)
+        self._shown_files = new_files
 
     def _emit_settings(self):
         settings = {
             'api_key': self.api_key_input.text().strip(),
             'model': self.model_input.text().strip(),
             'language': self.language_combo.currentText(),
-            'temperature': self.temperature_spinbox.value()
+            'temperature': self.temperature_spinbox.value(),
+            'history_limit': self.history_limit_spinbox.value(),
+            'semantic_cache': self.semantic_cache_checkbox.isChecked()
         }
         self.settings_applied.emit(settings)
 
@@ -313,6 +947,8 @@ class SettingsWidget(QWidget):
         self.model_input.setText(config_data.get('model', DEFAULT_MODEL))
         self.language_combo.setCurrentText(config_data.get('language', DEFAULT_LANGUAGE))
         self.temperature_spinbox.setValue(config_data.get('temperature', DEFAULT_TEMPERATURE))
+        self.history_limit_spinbox.setValue(config_data.get('history_limit', DEFAULT_HISTORY_LIMIT))
+        self.semantic_cache_checkbox.setChecked(bool(config_data.get('semantic_cache', False)))
 
     def set_status(self, message: str, is_error: bool = False):
         self.status_label.setText(f"Status: {message}")
@@ -320,12 +956,17 @@ class SettingsWidget(QWidget):
         self.status_label.setStyleSheet(f"color: {color}; padding: 5px; background-color: {STATUS_BG}; border-radius: 3px;")
 
     def set_controls_enabled(self, enabled: bool):
-        # Enable/disable all controls during processing
-        for w in [self.api_key_input, self.model_input, self.language_combo,
-                  self.temperature_spinbox, self.apply_button, self.pdf_list_widget,
-                  self.add_files_button, self.remove_files_button, self.clear_files_button,
-                  self.upload_button, self.back_button]:
-            w.setEnabled(enabled)
+        # Enable/disable all controls during processing, repainting once for the whole batch
+        self.setUpdatesEnabled(False)
+        try:
+            for w in (self.api_key_input, self.model_input, self.language_combo,
+                      self.temperature_spinbox, self.history_limit_spinbox, self.apply_button, self.pdf_list_widget,
+                      self.add_files_button, self.remove_files_button, self.clear_files_button,
+                      self.upload_button, self.back_button):
+                w.setEnabled(enabled)
+            self.semantic_cache_checkbox.setEnabled(enabled and semantic_cache_available)
+        finally:
+            self.setUpdatesEnabled(True)
 
 # ==================================
 # Chat Widget (Replaces CourseViewWidget)
@@ -342,6 +983,7 @@ class ChatWidget(QWidget):
         doc_layout.addWidget(QLabel("Focus Document:"))
         self.doc_selector_combo = QComboBox()
         self.doc_selector_combo.setToolTip("Select the course document to discuss with the AI")
+        self._shown_docs: Tuple[str, ...] = () # What doc_selector_combo currently lists, in order
         doc_layout.addWidget(self.doc_selector_combo, 1) # Allow stretching
         layout.addLayout(doc_layout)
 
@@ -349,6 +991,9 @@ class ChatWidget(QWidget):
         self.chat_display = QTextEdit()
         self.chat_display.setReadOnly(True)
         self.chat_display.setStyleSheet(f"background-color: {CHAT_BG}; border: 1px solid #ccc; border-radius: 3px;")
+        self._cursor = QTextCursor(self.chat_display.document()) # Appends at the end without re-laying out the whole document
+        self._vscroll = self.chat_display.verticalScrollBar() # Cached, used on every message/chunk
+        self._stream_format = QTextCharFormat(); self._stream_format.setForeground(QColor(AI_MSG_COLOR)) # Body of streamed AI messages
         layout.addWidget(self.chat_display, 1) # Allow stretching
 
         # Input Area
@@ -375,58 +1020,108 @@ class ChatWidget(QWidget):
             self.send_message_requested.emit(input_text)
             self.user_input_entry.clear()
 
-    def update_document_list(self, doc_basenames: List[str]):
-        """Populates the document selector, preserving current selection if possible."""
+    def update_document_list(self, doc_basenames: Iterable[str]):
+        """Populates the document selector (only adding/removing changed entries), preserving current selection if possible."""
+        new_docs = tuple(doc_basenames)
+        if new_docs == self._shown_docs: return # Most calls: nothing changed
+        shown = set(self._shown_docs); removed = shown.difference(new_docs)
         current_selection = self.doc_selector_combo.currentText()
-        self.doc_selector_combo.blockSignals(True) # Prevent triggering signal during update
-        self.doc_selector_combo.clear()
-        self.doc_selector_combo.addItems(doc_basenames)
-        # Try to restore selection
-        index = self.doc_selector_combo.findText(current_selection)
-        if index != -1:
-             self.doc_selector_combo.setCurrentIndex(index)
-        elif doc_basenames: # Select first item if previous is gone
-            self.doc_selector_combo.setCurrentIndex(0)
-
-        self.doc_selector_combo.blockSignals(False)
+        self.doc_selector_combo.setUpdatesEnabled(False) # One relayout for the whole refresh
+        with QSignalBlocker(self.doc_selector_combo): # Prevent triggering signal during update
+            if removed:
+                for index in range(self.doc_selector_combo.count() - 1, -1, -1):
+                    if self.doc_selector_combo.itemText(index) in removed: self.doc_selector_combo.removeItem(index)
+            self.doc_selector_combo.addItems([b for b in new_docs if b not in shown])
+            self._shown_docs = new_docs
+            # Try to restore selection
+            index = self.doc_selector_combo.findText(current_selection)
+            if index != -1:
+                 self.doc_selector_combo.setCurrentIndex(index)
+            elif new_docs: # Select first item if previous is gone
+                self.doc_selector_combo.setCurrentIndex(0)
+        self.doc_selector_combo.setUpdatesEnabled(True)
 
 
     def add_message(self, sender_role: str, text: str):
         """Adds a message to the chat display with appropriate styling."""
         # Basic HTML escaping for safety
-        text_escaped = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('\n', '<br>')
-
-        prefix = ""
-        color = "#000000" # Default
-
-        if sender_role == ROLE_AI:
-            prefix = "🤖 AI Tutor:"
-            color = AI_MSG_COLOR
-        elif sender_role == ROLE_USER:
-             prefix = "👤 You:"
-             color = USER_MSG_COLOR
-        elif sender_role == ROLE_SYSTEM:
-             prefix = "ℹ️ System:"
-             color = SYSTEM_MSG_COLOR
-             text_escaped = f"<i>{text_escaped}</i>" # Italicize system messages
-        else: # Fallback
-            prefix = f"{sender_role}:"
-
-        formatted_message = f'<div style="margin-bottom: 8px;"><b style="color:{color};">{prefix}</b><br><span style="color:{color};">{text_escaped}</span></div>'
-        self.chat_display.append(formatted_message)
-        self.chat_display.verticalScrollBar().setValue(self.chat_display.verticalScrollBar().maximum()) # Auto-scroll
+        text_escaped = text.translate(_HTML_ESCAPE_TABLE)
+
+        template = _ROLE_TEMPLATES.get(sender_role)
+        message_html = template % text_escaped if template else _FALLBACK_TEMPLATE % (sender_role, text_escaped)
+
+        # Only follow new messages if the user hasn't scrolled up to read older ones
+        at_bottom = self._is_scrolled_to_bottom()
+
+        self._cursor.movePosition(QTextCursor.MoveOperation.End)
+        if not self.chat_display.document().isEmpty():
+            self._cursor.insertBlock() # Start a new paragraph, like QTextEdit.append
+        self._cursor.insertHtml(message_html)
+        if at_bottom:
+            self._vscroll.setValue(self._vscroll.maximum()) # Auto-scroll
+
+    def _is_scrolled_to_bottom(self) -> bool:
+        return self._vscroll.value() >= self._vscroll.maximum() - 4
+
+    def begin_streamed_message(self, sender_role: str = ROLE_AI):
+        """Adds an empty message bubble whose body is then filled by append_chunk()."""
+        self.add_message(sender_role, "")
+
+    def append_chunk(self, text: str):
+        """Appends streamed text to the message started with begin_streamed_message()."""
+        at_bottom = self._is_scrolled_to_bottom()
+        self._cursor.movePosition(QTextCursor.MoveOperation.End)
+        self._cursor.insertText(text, self._stream_format) # Plain text, no HTML escaping/parsing needed
+        if at_bottom:
+            self._vscroll.setValue(self._vscroll.maximum())
 
     def clear_chat(self):
         self.chat_display.clear()
 
-    def set_input_enabled(self, enabled: bool):
-        self.user_input_entry.setEnabled(enabled)
-        self.send_button.setEnabled(enabled)
+    def replay_messages(self, messages):
+        """Replaces the chat display with the given (role, text) messages, repainting once."""
+        self.chat_display.setUpdatesEnabled(False)
+        self.clear_chat()
+        for role, text in messages:
+            self.add_message(role, text)
+        self.chat_display.setUpdatesEnabled(True)
+
+    def set_input_enabled(self, enabled: bool, keep_typing: bool = False):
+        # keep_typing: the user can keep sending (queued) messages while the rest is disabled
+        self.user_input_entry.setEnabled(enabled or keep_typing)
+        self.send_button.setEnabled(enabled or keep_typing)
         self.doc_selector_combo.setEnabled(enabled) # Allow changing doc only when idle
 
     def get_selected_document(self) -> Optional[str]:
         return self.doc_selector_combo.currentText() if self.doc_selector_combo.count() > 0 else None
 
+# ==================================
+# System Prompt
+# ==================================
+# Basic template - can be customized further. Only {language} and {doc} vary.
+SYSTEM_PROMPT_TEMPLATE = (
+    "You are 'Konenäkö Tutor', an AI assistant for a Machine Vision course teaching in {language}.\n"
+    "Your goal is to help the student understand the concepts presented ONLY in the provided course document: '{doc}'.\n"
+    "The document is provided via the File API and you should have access to it.\n\n"
+    "Based on our chat history and the document content, guide the student:\n"
+    "- Explain concepts clearly.\n"
+    "- Ask relevant questions.\n"
+    "- Provide exercises when appropriate.\n"
+    "- Offer constructive feedback.\n"
+    "- Maintain a supportive, conversational tone.\n"
+    "- Adapt based on the student's input.\n\n"
+    "CRITICAL RULES:\n"
+    "- Base ALL output STRICTLY on the provided document '{doc}'. If info isn't there, say so.\n"
+    "- Use citations like '[Page X]' or '[Section Y]' when referencing the document.\n"
+    "- Decide the conversational next step (explain, ask, exercise, etc.).\n"
+    "- Wait for the student's input after asking a question or giving an exercise."
+)
+
+@functools.lru_cache(maxsize=16)
+def _render_system_prompt(doc: str, language: str) -> str:
+    """Fills in the prompt template; reselecting a document reuses the rendered string."""
+    return SYSTEM_PROMPT_TEMPLATE.format(doc=doc, language=language)
+
 # ==================================
 # Main Application Window (Simplified)
 # ==================================
@@ -440,16 +1135,60 @@ class SimpleTutorApp(QMainWindow):
         self.config: Dict[str, Any] = {} # Store loaded config (api_key, model, etc.)
         self.local_file_paths: Dict[str, str] = {} # {basename: full_path}
         self.uploaded_files: Dict[str, File] = {} # {basename: FileAPI_Object} - Files ACTIVE on backend
+        self._uploaded_hashes: Dict[str, str] = {} # {basename: sha256 of the content that was uploaded}
+        self._saved_upload_handles: Dict[str, Dict[str, str]] = {} # {basename: {"name", "display_name", "sha256"}} from the config
+        self.upload_cache = FileUploadCache(UPLOAD_CACHE_FILE) # Skips re-uploading unchanged files
 
         self.model: Optional[GenerativeModel] = None
         self.current_chat_session: Optional[ChatSession] = None
-        self.current_chat_history: List[ContentDict] = []
+        # Per-document chat state, kept so switching documents reuses the warm server-side session
+        self._chat_sessions: Dict[str, ChatSession] = {} # {basename: ChatSession}
+        self._transcripts: Dict[str, _Transcript] = {} # {basename: everything shown in the chat}
+        self.current_transcript = _Transcript()
+        self._system_prompts: Dict[str, str] = {} # {basename: prompt frozen at session creation}
+        self._context_cached_docs: set = set() # Basenames whose session model holds document + prompt in a server-side cache
+        self._context_caches: Dict[Tuple[str, str, str], Any] = {} # {(model, uploaded file, system prompt): CachedContent, or None if caching failed for them}
+        self._model_options: Dict[str, Any] = {} # generation_config/safety_settings of self.model
+        self._history_snapshot: Optional[Tuple[int, List[Tuple[str, str]]]] = None # (id(session), serialized history) for the append-only debug check
         self.selected_doc_basename: Optional[str] = None
+        self._ai_message_streaming = False # True once the current AI answer has started rendering
+        self._response_cache: OrderedDict[str, Tuple[str, str]] = OrderedDict() # {turn key: (uploaded file, AI answer)}, least recently used first
+        self._pending_cache_key: Optional[str] = None # Key of the turn currently waiting for its answer
+        self._embedder = None # SentenceTransformer once EmbedderLoadWorker has loaded it
+        self._embedder_loader: Optional[EmbedderLoadWorker] = None # Keeps the loader's signals alive while it runs
+        self._genai_loader: Optional[GenaiImportWorker] = None # Set while the SDK is imported in the pool
+        self._semantic_cache: Dict[Tuple[str, str, str, Optional[str], int], Tuple[Any, List[str], List[int]]] = {} # {(model, doc, uploaded file, system prompt, history bucket): (embeddings [N, dim], answers, conversation ids)}
+        self._pending_semantic_slot: Optional[Tuple[str, str, str, Optional[str], int]] = None # Slot the current turn's question belongs to
+        self._pending_embedding: Optional[Tuple[Tuple[str, str, str, Optional[str], int], Any]] = None # (cache slot, question embedding) of the current turn, after a miss
         self.is_ai_configured = False
+        self._ai_config_hash: Optional[int] = None # _ai_identity_hash() of the last successful initialize_ai
+        self._configured_api_key: Optional[str] = None # Key genai.configure() was last called with
+        self._last_settings_hash: Optional[int] = None # Hash of the settings dict last saved via Apply
         self.is_processing = False # General flag for background tasks
-
-        self.thread: Optional[QThread] = None
-        self.worker: Optional[Union[AIChatWorker, PDFUploadWorker]] = None
+        self._last_status_text: Optional[str] = None # Status bar text/error state, to skip no-op updates
+        self._last_status_error: Optional[bool] = None
+
+        self.thread_pool = QThreadPool.globalInstance() # Reuses threads across chat turns and uploads
+        self.thread_pool.setMaxThreadCount(MAX_POOL_THREADS)
+        self.worker: Optional[Union[AIChatWorker, ChatInitWorker, PDFUploadWorker, UploadRehydrateWorker]] = None # Task currently running in the pool
+        self._deletion_workers: List[BackendDeleteWorker] = [] # Backend deletions still in flight
+        self._chat_worker: Optional[AIChatWorker] = None # Reused for every chat turn (auto-delete off)
+
+        # Coalesces bursts of file list changes into one background config write
+        self._save_timer = QTimer(self); self._save_timer.setSingleShot(True); self._save_timer.setInterval(2000)
+        self._save_timer.timeout.connect(self._do_save_config)
+        self._config_save_worker: Optional[ConfigSaveWorker] = None # Keeps the running save's signals alive
+        self._config_save_in_flight = False
+        self._config_save_pending = False # Save again once the in-flight write finishes
+        self._closing = False # Close requested; waiting for the final config write
+        self._close_ready = False # Final config write done, the next closeEvent is accepted
+        self._cancel_event = threading.Event() # Set on close; chat workers poll it between streamed chunks
+
+        # Coalesces user messages sent while the AI is answering into one follow-up turn
+        self._pending_user_msgs: List[str] = [] # Shown in the chat, not yet sent to the AI
+        self._held_user_msgs: List[str] = [] # Typed while the AI answers; shown and queued once the answer is complete
+        self._send_timer = QTimer(self); self._send_timer.setSingleShot(True); self._send_timer.setInterval(USER_BATCH_WINDOW_MS)
+        self._send_timer.timeout.connect(self._flush_pending_messages)
 
         # --- UI ---
         self.central_widget = QWidget()
@@ -461,40 +1200,34 @@ class SimpleTutorApp(QMainWindow):
 
         self.view_stack = QStackedWidget()
         self.chat_widget = ChatWidget()
-        self.settings_widget = SettingsWidget()
+        self.settings_widget: Optional[SettingsWidget] = None # Built on first visit by _ensure_settings_widget()
         self.view_stack.addWidget(self.chat_widget)    # Index 0
-        self.view_stack.addWidget(self.settings_widget) # Index 1
         self.main_layout.addWidget(self.view_stack, 1) # Allow view stack to stretch
 
         self._create_status_bar()
 
         # --- Connections ---
-        self.settings_button.clicked.connect(self.show_settings_view)
-        self.settings_widget.back_button.clicked.connect(self.show_chat_view)
-        self.settings_widget.settings_applied.connect(self.apply_and_save_settings)
-        self.settings_widget.files_added.connect(self.add_files)
-        self.settings_widget.files_removed.connect(self.remove_files)
-        self.settings_widget.files_cleared.connect(self.clear_all_files)
-        self.settings_widget.upload_requested.connect(self.upload_files_to_ai)
+        direct = Qt.ConnectionType.DirectConnection # All of these are GUI-thread to GUI-thread
+        self.settings_button.clicked.connect(self.show_settings_view, direct)
 
-        self.chat_widget.send_message_requested.connect(self.handle_user_message)
-        self.chat_widget.doc_selector_combo.currentTextChanged.connect(self.handle_document_selection_change)
+        self.chat_widget.send_message_requested.connect(self.handle_user_message, direct)
+        self.chat_widget.doc_selector_combo.currentTextChanged.connect(self.handle_document_selection_change, direct)
 
         # --- Initialization ---
         self.apply_stylesheet() # Apply basic styling
         self.load_config()      # Load API key, settings
         self._update_ui_state() # Populate file lists etc.
         self.show_chat_view()   # Start on chat view
+        self._update_semantic_cache_state()
         if self.config.get('api_key'):
             QTimer.singleShot(100, self.initialize_ai) # Try configuring AI early if key exists
         else:
              self.update_status("AI not configured. Please add API Key in Settings.", is_error=True)
 
     def _create_header(self):
-        self.header_widget = QFrame(); self.header_widget.setObjectName("Header")
-        self.header_widget.setStyleSheet(f"background-color: {APP_BG_COLOR}; border-bottom: 1px solid #ccc; padding: 5px;")
+        self.header_widget = QFrame(); self.header_widget.setObjectName("Header") # Styled by _STYLESHEET
         header_layout = QHBoxLayout(self.header_widget); header_layout.setContentsMargins(10, 5, 10, 5)
-        title = QLabel("Konenäkö Tutor"); title.setFont(QFont(FONT_FAMILY, 12, QFont.Weight.Bold))
+        title = QLabel("Konenäkö Tutor"); title.setFont(_bold_font(12))
         header_layout.addWidget(title); header_layout.addStretch()
         self.settings_button = QPushButton("⚙️ Settings"); self.settings_button.setFixedSize(QSize(100, 30))
         self.settings_button.setObjectName("SettingsButton")
@@ -503,7 +1236,7 @@ class SimpleTutorApp(QMainWindow):
 
     def _create_status_bar(self):
         self.status_bar_label = QLabel("Initializing...")
-        self.status_bar_label.setStyleSheet(f"background-color: {STATUS_BG}; padding: 5px 10px; color: {SYSTEM_MSG_COLOR};")
+        self.status_bar_label.setObjectName("StatusBar") # Styled by _STYLESHEET; the "error" property switches the color
         self.main_layout.addWidget(self.status_bar_label)
 
     def update_status(self, message: str, is_error: bool = False, processing: bool = False):
@@ -512,40 +1245,34 @@ class SimpleTutorApp(QMainWindow):
 
         status_prefix = "⏳" if processing else ("❌" if is_error else "ℹ️")
         full_message = f"{status_prefix} {message}"
-        self.status_bar_label.setText(full_message)
-        color = ERROR_MSG_COLOR if is_error else SYSTEM_MSG_COLOR
-        self.status_bar_label.setStyleSheet(f"background-color: {STATUS_BG}; padding: 5px 10px; color: {color};")
+        # Repeated progress messages are common; only touch the labels when something visible changed
+        if full_message != self._last_status_text:
+            self.status_bar_label.setText(full_message)
+        if is_error != self._last_status_error:
+            self.status_bar_label.setProperty("error", is_error)
+            style = self.status_bar_label.style(); style.unpolish(self.status_bar_label); style.polish(self.status_bar_label) # Re-apply the property selector
 
         # Update settings status too
-        self.settings_widget.set_status(message, is_error)
+        if self.settings_widget and (full_message != self._last_status_text or is_error != self._last_status_error):
+            self.settings_widget.set_status(message, is_error)
+        self._last_status_text = full_message; self._last_status_error = is_error
 
         # Enable/disable controls based on processing state
         self.set_controls_enabled(not processing)
-        QApplication.processEvents() # Ensure UI updates immediately
+        # No processEvents() here: re-entering the event loop would deliver queued worker signals
+        # mid-update. Qt paints between events; callers about to block the GUI thread repaint themselves.
 
 
     def set_controls_enabled(self, enabled: bool):
         """Enable/disable relevant controls during processing."""
         self.chat_widget.set_input_enabled(enabled)
-        self.settings_widget.set_controls_enabled(enabled)
+        if self.settings_widget: self.settings_widget.set_controls_enabled(enabled)
         self.settings_button.setEnabled(enabled)
         # Keep upload button enabled status tied to having files, handled in _update_ui_state
 
     def apply_stylesheet(self):
-        # Apply simple QSS
-        self.setStyleSheet(f"""
-            QMainWindow {{ background-color: {APP_BG_COLOR}; }}
-            QGroupBox {{ font-weight: bold; border: 1px solid #ccc; border-radius: 4px; margin-top: 10px; padding: 10px; }}
-            QGroupBox::title {{ subcontrol-origin: margin; subcontrol-position: top left; padding: 0 5px; left: 10px; }}
-            QPushButton {{ background-color: #E0E0E0; border: 1px solid #bbb; border-radius: 3px; padding: 5px 10px; min-height: 20px;}}
-            QPushButton:hover {{ background-color: #d0d0d0; border: 1px solid #999; }}
-            QPushButton:disabled {{ background-color: #f5f5f5; color: #aaa; }}
-            #SendButton, #UploadButton, #ApplyButton {{ background-color: {BUTTON_COLOR}; color: {BUTTON_TEXT_COLOR}; border: none; }}
-            #SendButton:hover, #UploadButton:hover, #ApplyButton:hover {{ background-color: {BUTTON_HOVER_COLOR}; }}
-            #BackButton {{ /* Custom style if needed */ }}
-            QLineEdit, QComboBox, QDoubleSpinBox, QTextEdit {{ border: 1px solid #ccc; border-radius: 3px; padding: 5px; background-color: #fff; }}
-            QListWidget {{ border: 1px solid #ccc; border-radius: 3px; background-color: #fff; }}
-        """)
+        # Apply simple QSS (includes the header and status bar styles)
+        self.setStyleSheet(_STYLESHEET)
 
     # --- View Management ---
     def show_chat_view(self):
@@ -553,110 +1280,244 @@ class SimpleTutorApp(QMainWindow):
         self._update_ui_state() # Ensure doc selector is up-to-date
 
     def show_settings_view(self):
+        self._ensure_settings_widget()
         self.settings_widget.load_settings(self.config) # Load current config into view
-        self.settings_widget.update_file_list(list(self.local_file_paths.keys()))
+        self.settings_widget.update_file_list(self.local_file_paths.keys())
         self.update_status("Viewing Settings.") # Update status via main method
         self.view_stack.setCurrentIndex(1)
 
+    def _ensure_settings_widget(self):
+        """Creates the settings view on first use; most sessions never leave the chat view."""
+        if self.settings_widget: return
+        self.settings_widget = SettingsWidget()
+        self._last_status_text = None # So the next update_status also fills the new widget's status label
+        self._wire_settings_signals()
+        self.view_stack.addWidget(self.settings_widget) # Index 1
+        self.settings_widget.upload_button.setEnabled(bool(self.local_file_paths) and self.is_ai_configured)
+
+    def _wire_settings_signals(self):
+        direct = Qt.ConnectionType.DirectConnection # All of these are GUI-thread to GUI-thread
+        self.settings_widget.back_button.clicked.connect(self.show_chat_view, direct)
+        self.settings_widget.settings_applied.connect(self.apply_and_save_settings, direct)
+        self.settings_widget.files_added.connect(self.add_files, direct)
+        self.settings_widget.files_removed.connect(self.remove_files, direct)
+        self.settings_widget.files_cleared.connect(self.clear_all_files, direct)
+        self.settings_widget.upload_requested.connect(self.upload_files_to_ai, direct)
+
     # --- Config Management ---
     def load_config(self):
         """Loads settings from the INI file."""
         config = configparser.ConfigParser()
         defaults = {
             'api_key': '', 'model': DEFAULT_MODEL, 'language': DEFAULT_LANGUAGE,
-            'temperature': str(DEFAULT_TEMPERATURE), 'files': '{}' # Store file paths as JSON dict
+            'temperature': str(DEFAULT_TEMPERATURE), 'history_limit': str(DEFAULT_HISTORY_LIMIT),
+            'files': '{}', # Store file paths as JSON dict
+            'uploaded_handles': '{}' # File API handles of uploaded files, as JSON dict
         }
         if os.path.exists(CONFIG_FILE):
             try:
-                config.read(CONFIG_FILE)
+                config.read(CONFIG_FILE, encoding='utf-8')
                 self.config['api_key'] = config.get('Settings', 'APIKey', fallback=defaults['api_key'])
                 self.config['model'] = config.get('Settings', 'Model', fallback=defaults['model'])
                 self.config['language'] = config.get('Settings', 'Language', fallback=defaults['language'])
                 self.config['temperature'] = config.getfloat('Settings', 'Temperature', fallback=float(defaults['temperature']))
+                self.config['history_limit'] = config.getint('Settings', 'HistoryLimit', fallback=int(defaults['history_limit']))
+                self.config['semantic_cache'] = config.getboolean('Settings', 'SemanticCache', fallback=False)
                 # Load file paths
                 files_json = config.get('Files', 'LocalPaths', fallback=defaults['files'])
-                self.local_file_paths = json.loads(files_json)
+                self.local_file_paths = _json_loads(files_json)
+                self._saved_upload_handles = _json_loads(config.get('Files', 'UploadedHandles', fallback=defaults['uploaded_handles']))
 
             except (configparser.Error, json.JSONDecodeError, ValueError, KeyError) as e:
                 print(f"Error loading config: {e}. Using defaults.")
                 self.config = {k: (float(v) if k=='temperature' else v) for k,v in defaults.items()}
+                self.config['history_limit'] = DEFAULT_HISTORY_LIMIT
+                self.config['semantic_cache'] = False
                 self.config['files'] = json.loads(defaults['files']) # Ensure files is dict
                 self.local_file_paths = {}
+                self._saved_upload_handles = {}
                 # Optionally warn user about config reset
                 QMessageBox.warning(self, "Config Load Error", f"Could not load settings from {CONFIG_FILE}. Using defaults.\nError: {e}")
         else:
              print("Config file not found, using defaults.")
              self.config = {k: (float(v) if k=='temperature' else v) for k,v in defaults.items()}
+             self.config['history_limit'] = DEFAULT_HISTORY_LIMIT
+             self.config['semantic_cache'] = False
              self.local_file_paths = {}
 
         print(f"Config loaded: Model={self.config.get('model')}, Lang={self.config.get('language')}, Temp={self.config.get('temperature')}")
         print(f"Local file paths loaded: {len(self.local_file_paths)} files")
 
 
-    def save_config(self):
-        """Saves current settings and file paths to INI."""
+    def _render_config(self) -> Tuple[str, Dict[str, Dict[str, str]]]:
+        """Returns the INI text for the current settings and file paths, plus the upload handles it contains."""
         config = configparser.ConfigParser()
         config['Settings'] = {
             'APIKey': self.config.get('api_key', ''),
             'Model': self.config.get('model', DEFAULT_MODEL),
             'Language': self.config.get('language', DEFAULT_LANGUAGE),
-            'Temperature': str(self.config.get('temperature', DEFAULT_TEMPERATURE))
+            'Temperature': str(self.config.get('temperature', DEFAULT_TEMPERATURE)),
+            'HistoryLimit': str(self.config.get('history_limit', DEFAULT_HISTORY_LIMIT)),
+            'SemanticCache': str(bool(self.config.get('semantic_cache', False)))
         }
+        upload_handles = {basename: {'name': file_obj.name, 'display_name': file_obj.display_name, 'sha256': self._uploaded_hashes[basename]}
+                          for basename, file_obj in self.uploaded_files.items() if basename in self._uploaded_hashes}
+        if not self.is_ai_configured: # Not rehydrated yet this session; keep what the last session saved
+            upload_handles = {**{b: h for b, h in self._saved_upload_handles.items() if b in self.local_file_paths}, **upload_handles}
         config['Files'] = {
-            'LocalPaths': json.dumps(self.local_file_paths or {})
+            'LocalPaths': _json_dumps(self.local_file_paths or {}),
+            'UploadedHandles': _json_dumps(upload_handles)
         }
+        buffer = io.StringIO() # Compact JSON keeps non-ASCII paths as-is
+        config.write(buffer)
+        return buffer.getvalue(), upload_handles
+
+    def save_config(self):
+        """Saves current settings and file paths to INI now (atomically), reporting errors to the user."""
+        config_text, upload_handles = self._render_config()
         try:
-            with open(CONFIG_FILE, 'w') as configfile:
-                config.write(configfile)
-            print("Config saved.")
+            _write_file_atomic(CONFIG_FILE, config_text)
+            self.upload_cache.save() # No-op unless a worker changed it without saving
+            self._on_config_written(upload_handles)
+            if self._config_save_in_flight: self._config_save_pending = True # An older background write may land after this one
             return True
         except Exception as e:
             print(f"Error saving config: {e}")
             QMessageBox.critical(self, "Config Save Error", f"Could not write settings to {CONFIG_FILE}.\nError: {e}")
             return False
 
+    def _schedule_save_config(self):
+        """Saves the config shortly; repeated calls within the interval result in a single write."""
+        self._save_timer.start() # Restarts the countdown if already pending
+
+    @Slot()
+    def _do_save_config(self):
+        """Writes the config in the pool; the text is rendered here, so the worker never touches app state."""
+        if self._config_save_in_flight:
+            self._config_save_pending = True; return # One write at a time, so an older one can't land last
+        config_text, upload_handles = self._render_config()
+        self._config_save_worker = ConfigSaveWorker(CONFIG_FILE, config_text, upload_handles, self.upload_cache)
+        queued = Qt.ConnectionType.QueuedConnection # Emitted from a pool thread, delivered on the GUI thread
+        self._config_save_worker.signals.saved.connect(self._handle_config_saved, queued)
+        self._config_save_worker.signals.failed.connect(self._handle_config_save_failed, queued)
+        self._config_save_in_flight = True
+        self.thread_pool.start(self._config_save_worker)
+
+    def _on_config_written(self, upload_handles: Dict[str, Dict[str, str]]):
+        self._saved_upload_handles = upload_handles
+        print("Config saved.")
+
+    @Slot(object)
+    def _handle_config_saved(self, upload_handles: Dict[str, Dict[str, str]]):
+        self._on_config_written(upload_handles)
+        self._background_save_finished()
+
+    @Slot(str)
+    def _handle_config_save_failed(self, error_message: str):
+        print(f"Error saving config: {error_message}")
+        if not self._closing: self.update_status(f"Could not save settings: {error_message}", is_error=True)
+        self._background_save_finished()
+
+    def _background_save_finished(self):
+        self._config_save_in_flight = False; self._config_save_worker = None
+        if self._closing: # closeEvent waited for this write; the final one is done here, then the window closes
+            self._config_save_pending = False
+            self.save_config() # Synchronous, reports a failure before the window goes away
+            self._close_ready = True; self.close()
+        elif self._config_save_pending: # Changed meanwhile, or a foreground save raced this one
+            self._config_save_pending = False; self._do_save_config()
+
     @Slot(dict)
     def apply_and_save_settings(self, settings: Dict[str, Any]):
         """Applies settings from the widget, saves, and reconfigures AI if needed."""
         if self.is_processing:
             QMessageBox.warning(self, "Busy", "Cannot change settings while a task is running."); return
 
+        settings_hash = hash(frozenset(settings.items()))
+        # Nothing to write or reconnect; a failed AI setup is still retried below
+        if settings_hash == self._last_settings_hash and self._ai_identity_hash() == self._ai_config_hash:
+            self.update_status("No changes."); return
+
         print("Applying settings:", settings)
-        old_api_key = self.config.get('api_key')
-        old_model = self.config.get('model')
 
         # Update internal config state
+        language_changed = settings.get('language') != self.config.get('language')
         self.config.update(settings)
 
         # Save updated config to file
         if self.save_config():
+             self._last_settings_hash = settings_hash
              self.update_status("Settings saved.")
-             # Check if AI reconfiguration is needed
-             if settings.get('api_key') != old_api_key or settings.get('model') != old_model:
+             self._update_semantic_cache_state()
+             # Re-initialize only if key/model differ from the last *successful* setup
+             # (so a failed setup is retried, while a no-op Apply skips the network round trip)
+             if self._ai_identity_hash() != self._ai_config_hash:
                  self.update_status("API Key or Model changed, re-initializing AI...")
                  self.initialize_ai() # Re-run AI setup
-             # If only language/temp changed, the next chat session will use them
+             elif language_changed:
+                 self._restart_chats_with_new_prompt()
+             # Temperature is part of the model, so it applies when the AI is next initialized
         else:
             self.update_status("Failed to save settings.", is_error=True)
 
 
+    def _restart_chats_with_new_prompt(self):
+        """Drops every document's session, since each one froze its system prompt (and so the tutor language)
+        when it started, and restarts the current document's chat with the new prompt."""
+        self._discard_chat_sessions()
+        self.current_chat_session = None
+        self.current_transcript = _Transcript()
+        self.chat_widget.clear_chat()
+        self._try_start_chat_session()
+
+
+    def _update_semantic_cache_state(self):
+        """Loads the embedder in the background when the semantic cache is enabled; drops it all when disabled."""
+        if not self.config.get('semantic_cache') or not semantic_cache_available:
+            self._embedder = None; self._semantic_cache.clear(); return
+        if self._embedder is not None or self._embedder_loader is not None: return # Loaded or loading
+        self._embedder_loader = EmbedderLoadWorker()
+        self._embedder_loader.signals.loaded.connect(self._handle_embedder_loaded, Qt.ConnectionType.QueuedConnection)
+        self.thread_pool.start(self._embedder_loader)
+
+    @Slot(object)
+    def _handle_embedder_loaded(self, embedder):
+        self._embedder_loader = None
+        if self.config.get('semantic_cache'): self._embedder = embedder # Setting may have been turned off meanwhile
+        print("Semantic cache ready." if self._embedder is not None else "Semantic cache unavailable.")
+
+
     # --- AI Initialization ---
+    def _ai_identity_hash(self) -> int:
+        """Digest of the settings that require re-initializing the AI when they change."""
+        return hash((self.config.get('api_key'), self.config.get('model')))
+
     def initialize_ai(self):
-        """Configures the Gemini API and creates the GenerativeModel instance."""
-        if not gemini_imported:
-             self.update_status("Google AI library not installed.", is_error=True); return False
+        """Configures the Gemini API and creates the GenerativeModel instance.
+        The first call only starts importing the SDK in the pool; it is called again once that is done."""
+        if genai is None:
+            if not gemini_imported:
+                self.update_status("Google AI library not installed.", is_error=True); return False
+            self._load_genai(); return False
         api_key = self.config.get('api_key')
         model_name = self.config.get('model')
         if not api_key or not model_name:
              self.update_status("API Key or Model Name missing in settings.", is_error=True); return False
 
         self.update_status("Configuring AI...", processing=True)
+        self.status_bar_label.repaint() # Show it before the blocking configure/model setup below
         self.is_ai_configured = False
+        self._ai_config_hash = None
         self.model = None
         self.current_chat_session = None # Invalidate chat session
+        self._discard_chat_sessions() # Sessions are bound to the old model
 
         try:
-            genai.configure(api_key=api_key)
+            # Re-configuring replaces the SDK's process-wide clients (and their open gRPC channels),
+            # so it is only done when the key changes; a new model name reuses the warm connection.
+            if api_key != self._configured_api_key:
+                genai.configure(api_key=api_key, transport="grpc") # One long-lived HTTP/2 channel per service
+                self._configured_api_key = api_key
             # Safety settings (Example: block dangerous content)
             safety_settings = {
                  HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
@@ -665,6 +1526,7 @@ class SimpleTutorApp(QMainWindow):
                  HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
             }
             generation_config = GenerationConfigDict(temperature=self.config.get('temperature', DEFAULT_TEMPERATURE))
+            self._model_options = {'generation_config': generation_config, 'safety_settings': safety_settings}
 
             self.model = GenerativeModel(
                 model_name,
@@ -674,10 +1536,12 @@ class SimpleTutorApp(QMainWindow):
             )
 
             self.is_ai_configured = True
+            self._ai_config_hash = self._ai_identity_hash()
+            self._drop_context_caches(lambda key: key[0] != self.model.model_name) # Same-model caches stay reusable
             self.update_status(f"AI Configured: '{model_name}'. Ready.", processing=False)
             print(f"AI Configured: Model='{model_name}', Temp={self.config.get('temperature')}")
-            # After successful config, check if we can start a chat
-            self._try_start_chat_session()
+            # After successful config, restore last session's uploads, then check if we can start a chat
+            self._rehydrate_uploaded_files()
             return True
 
         except (google.api_core.exceptions.PermissionDenied, google.api_core.exceptions.Unauthenticated) as auth_err:
@@ -696,25 +1560,82 @@ class SimpleTutorApp(QMainWindow):
                  self.current_chat_session = None
 
 
+    def _load_genai(self):
+        """Imports the SDK in the pool, so the window stays responsive; initialize_ai continues from the signal."""
+        if self._genai_loader is not None: return # Already importing
+        self.update_status("Loading AI library...", processing=True)
+        self._genai_loader = GenaiImportWorker()
+        self._genai_loader.signals.finished.connect(self._handle_genai_loaded, Qt.ConnectionType.QueuedConnection)
+        self.thread_pool.start(self._genai_loader)
+
+    @Slot(bool)
+    def _handle_genai_loaded(self, available: bool):
+        self._genai_loader = None
+        if available: self.initialize_ai()
+        else: self.update_status("Google AI library not installed.", is_error=True, processing=False)
+
+
+    def _rehydrate_uploaded_files(self):
+        """Reuses earlier uploads of local files (saved handles, content-hash cache) instead of uploading them again."""
+        file_paths = {b: p for b, p in self.local_file_paths.items() if b not in self.uploaded_files}
+        if not file_paths or not (self._saved_upload_handles or len(self.upload_cache)):
+            self._try_start_chat_session(); return
+
+        self.update_status(f"Checking {len(file_paths)} file(s) for earlier uploads...", processing=True)
+        self._start_worker(UploadRehydrateWorker(file_paths, dict(self._saved_upload_handles), self.upload_cache),
+                           finished=self._handle_rehydrate_finished)
+
+    @Slot(list)
+    def _handle_rehydrate_finished(self, restored: List[Tuple[File, str]]):
+        self.worker = None # Task complete
+        for file_obj, sha256 in restored:
+            basename = file_obj.display_name
+            if basename in self.local_file_paths:
+                self.uploaded_files[basename] = file_obj
+                self._uploaded_hashes[basename] = sha256
+        print(f"Reusing {len(restored)} earlier upload(s).")
+        total_local = len(self.local_file_paths)
+        if len(self.uploaded_files) < total_local:
+            self.update_status(f"Active on backend: {len(self.uploaded_files)}/{total_local}. Upload the rest in Settings.", processing=False)
+        else:
+            self.update_status(f"All {total_local} files are active on backend.", processing=False)
+        self._update_ui_state()
+        self._try_start_chat_session()
+
+
     # --- File Management ---
     @Slot(list)
     def add_files(self, file_paths: List[str]):
         if self.is_processing: QMessageBox.warning(self, "Busy", "Cannot add files now."); return
-        added = 0
+        # One pass collecting outcomes; problems are reported together in a single dialog afterwards
+        existing = set(self.local_file_paths)
+        new_paths: Dict[str, str] = {} # {basename: path}
+        missing: List[str] = []
+        duplicates: List[str] = []
+        present = _find_existing_files(file_paths) # One directory listing per folder instead of a stat per file
         for path in file_paths:
-            if not os.path.exists(path):
-                 QMessageBox.warning(self, "File Not Found", f"Skipping missing file: {path}"); continue
+            if path not in present:
+                 missing.append(path); continue
             basename = os.path.basename(path)
-            if basename not in self.local_file_paths:
-                 self.local_file_paths[basename] = path
-                 added += 1
+            if basename in existing or basename in new_paths:
+                 duplicates.append(basename)
             else:
-                 QMessageBox.warning(self, "Duplicate File", f"'{basename}' is already in the list.")
+                 new_paths[basename] = path
+        added = len(new_paths)
+
         if added > 0:
+            self.local_file_paths.update(new_paths)
             print(f"Added {added} files to local list.")
-            self.save_config() # Save updated file list
+            self._schedule_save_config() # Save updated file list
             self._update_ui_state()
             self.update_status(f"Added {added} files. Please 'Upload to AI'.")
+            if self.is_ai_configured and len(self.upload_cache):
+                self._rehydrate_uploaded_files() # Content uploaded before needs no upload
+        if missing or duplicates:
+            details = [f"Added {added} file(s)."]
+            if duplicates: details.append(f"Skipped {len(duplicates)} already in the list: " + ", ".join(duplicates))
+            if missing: details.append(f"Skipped {len(missing)} missing: " + ", ".join(missing))
+            QMessageBox.information(self, "Files Added", "\n".join(details))
 
     @Slot(list)
     def remove_files(self, basenames_to_remove: List[str]):
@@ -730,17 +1651,22 @@ class SimpleTutorApp(QMainWindow):
                 if basename in self.uploaded_files:
                      files_to_delete_backend.append(self.uploaded_files[basename])
                      del self.uploaded_files[basename] # Remove from uploaded dict too
+                self._uploaded_hashes.pop(basename, None)
 
         if removed_count > 0:
             # If the currently selected doc was removed, reset selection/chat
+            self._discard_chat_sessions(basenames_to_remove)
             if self.selected_doc_basename in basenames_to_remove:
                 print(f"Selected document '{self.selected_doc_basename}' was removed. Resetting chat.")
                 self.selected_doc_basename = None
                 self.current_chat_session = None
-                self.current_chat_history = []
+                self.current_transcript = _Transcript()
                 self.chat_widget.clear_chat()
 
-            self.save_config() # Save updated local list
+            self._schedule_save_config() # Save updated local list
+            removed_file_ids = {f.name for f in files_to_delete_backend}
+            self._drop_context_caches(lambda key: key[1] in removed_file_ids)
+            self._purge_cached_answers(removed_file_ids)
             self._attempt_backend_deletion(files_to_delete_backend)
             self._update_ui_state()
             self.update_status(f"Removed {removed_count} files.")
@@ -759,13 +1685,18 @@ class SimpleTutorApp(QMainWindow):
         files_to_delete_backend = list(self.uploaded_files.values())
         self.local_file_paths = {}
         self.uploaded_files = {}
+        self._uploaded_hashes = {}
+        self._saved_upload_handles = {}
         self.selected_doc_basename = None
         self.current_chat_session = None
-        self.current_chat_history = []
+        self.current_transcript = _Transcript()
+        self._discard_chat_sessions()
         self.chat_widget.clear_chat()
         print("Cleared all local files and active uploads.")
 
-        self.save_config()
+        self._schedule_save_config()
+        self._drop_context_caches(lambda key: True)
+        self._purge_cached_answers({f.name for f in files_to_delete_backend})
         self._attempt_backend_deletion(files_to_delete_backend)
         self._update_ui_state()
         self.update_status("Cleared all files.")
@@ -777,23 +1708,22 @@ class SimpleTutorApp(QMainWindow):
              print("Skipping backend deletion: AI not configured.")
              return
 
+        file_api_objects = [f for f in file_api_objects if f and hasattr(f, 'name')]
+        if not file_api_objects: return
         print(f"Attempting backend deletion for {len(file_api_objects)} file(s)...")
-        # Consider doing this in a thread if many files? For now, do it synchronously.
-        deleted_count = 0
-        failed_count = 0
-        for file_obj in file_api_objects:
-             if not file_obj or not hasattr(file_obj, 'name'): continue
-             try:
-                 genai.delete_file(file_obj.name)
-                 print(f"  Deleted '{getattr(file_obj, 'display_name', file_obj.name)}' from backend.")
-                 deleted_count += 1
-             except Exception as e:
-                 print(f"  Warning: Failed deleting '{getattr(file_obj, 'display_name', file_obj.name)}': {e}")
-                 failed_count += 1
+        # Runs in the pool, so N HTTPS round trips don't freeze the UI
+        worker = BackendDeleteWorker(file_api_objects)
+        worker.signals.finished.connect(self._handle_backend_deletion_finished, Qt.ConnectionType.QueuedConnection)
+        self._deletion_workers.append(worker) # Keep its signals alive until it reports back
+        self.thread_pool.start(worker)
+
+    @Slot(int, int)
+    def _handle_backend_deletion_finished(self, deleted_count: int, failed_count: int):
+        self._deletion_workers = [w for w in self._deletion_workers if w.signals is not self.sender()]
         if failed_count > 0:
              QMessageBox.warning(self, "Backend Deletion Issue", f"Failed to delete {failed_count} file(s) from the AI backend. They might need manual cleanup.")
         elif deleted_count > 0:
-             print("Backend deletion completed.")
+             print(f"Backend deletion completed ({deleted_count} file(s)).")
 
 
     # --- File Upload ---
@@ -805,46 +1735,45 @@ class SimpleTutorApp(QMainWindow):
 
         # Check which files need uploading (local list vs self.uploaded_files)
         files_to_upload_basenames = list(self.local_file_paths.keys() - self.uploaded_files.keys())
-        paths_to_upload = [self.local_file_paths[b] for b in files_to_upload_basenames if b in self.local_file_paths]
+        paths_to_upload = [self.local_file_paths[b] for b in files_to_upload_basenames]
 
         if not paths_to_upload:
              QMessageBox.information(self, "Up-to-date", "All local files appear to be already uploaded."); return
 
-        # Check files exist before starting worker
-        missing_files = [p for p in paths_to_upload if not os.path.exists(p)]
+        # Check files exist before starting worker (one directory listing per folder)
+        existing_files = _find_existing_files(paths_to_upload)
+        missing_files = [p for p in paths_to_upload if p not in existing_files]
         if missing_files:
              QMessageBox.critical(self, "File Not Found", f"Cannot upload. Missing:\n" + "\n".join(missing_files)); return
 
         self.update_status(f"Starting upload for {len(paths_to_upload)} file(s)...", processing=True)
 
-        self.thread = QThread(self)
-        self.worker = PDFUploadWorker(paths_to_upload, files_to_upload_basenames)
-        self.worker.moveToThread(self.thread)
-
-        # Connect signals
-        self.worker.progress_update.connect(lambda msg: self.update_status(msg, processing=True))
-        # self.worker.file_processed.connect(...) # Can add detailed status later
-        self.worker.finished.connect(self._handle_upload_finished)
-        self.worker.error_occurred.connect(self._handle_upload_error)
-        self.thread.started.connect(self.worker.run)
-        # Cleanup connections
-        self.worker.finished.connect(self.thread.quit)
-        self.worker.error_occurred.connect(self.thread.quit)
-        self.thread.finished.connect(self._on_thread_finished)
-        self.thread.finished.connect(self.worker.deleteLater)
-        self.thread.finished.connect(self.thread.deleteLater)
-
-        self.thread.start()
+        # file_processed could drive detailed status later
+        self._start_worker(PDFUploadWorker(paths_to_upload, files_to_upload_basenames, self.upload_cache),
+                           progress_update=self._on_upload_progress,
+                           file_hashed=self._on_file_hashed,
+                           finished=self._handle_upload_finished,
+                           error_occurred=self._handle_upload_error)
+
+    @Slot(str)
+    def _on_upload_progress(self, message: str):
+        self.update_status(message, processing=True)
+
+    @Slot(str, str)
+    def _on_file_hashed(self, basename: str, sha256: str):
+        self._uploaded_hashes[basename] = sha256
 
     @Slot(list)
     def _handle_upload_finished(self, uploaded_file_objects: List[File]):
         print(f"Upload worker finished. Received {len(uploaded_file_objects)} potential file objects.")
+        self.worker = None # Task complete
         newly_uploaded_count = 0
+        uploaded = self.uploaded_files; local = self.local_file_paths # Bound once for the loop
         if uploaded_file_objects:
             for file_obj in uploaded_file_objects:
                 basename = getattr(file_obj, 'display_name', None)
-                if basename and basename in self.local_file_paths: # Check if it's one we requested
-                    self.uploaded_files[basename] = file_obj
+                if basename and basename in local: # Check if it's one we requested
+                    uploaded[basename] = file_obj
                     newly_uploaded_count += 1
                 else:
                     print(f"Warning: Received unexpected/invalid file object: {basename}. Ignoring.")
@@ -852,8 +1781,8 @@ class SimpleTutorApp(QMainWindow):
                     if hasattr(file_obj, 'name'):
                          self._attempt_backend_deletion([file_obj])
 
-        total_uploaded = len(self.uploaded_files)
-        total_local = len(self.local_file_paths)
+        total_uploaded = len(uploaded)
+        total_local = len(local)
         if newly_uploaded_count > 0:
             self.update_status(f"Uploaded {newly_uploaded_count} file(s). Total active: {total_uploaded}/{total_local}.", processing=False)
         elif total_uploaded == total_local and total_local > 0:
@@ -869,6 +1798,7 @@ class SimpleTutorApp(QMainWindow):
     @Slot(str)
     def _handle_upload_error(self, error_message: str):
         print(f"Upload Error: {error_message}")
+        self.worker = None # Task complete
         QMessageBox.critical(self, "Upload Error", error_message)
         self.update_status(f"Upload failed: {error_message.split(':')[0]}", is_error=True, processing=False)
         # Keep existing uploaded files, user might retry
@@ -883,37 +1813,54 @@ class SimpleTutorApp(QMainWindow):
 
         if selected_basename not in self.uploaded_files:
             QMessageBox.warning(self, "File Not Uploaded", f"'{selected_basename}' has not been successfully uploaded to the AI. Please use 'Upload to AI' in Settings.")
-            # Revert selection in combo box?
-            self.chat_widget.doc_selector_combo.blockSignals(True)
-            index = self.chat_widget.doc_selector_combo.findText(self.selected_doc_basename or "")
-            self.chat_widget.doc_selector_combo.setCurrentIndex(index if index != -1 else 0)
-            self.chat_widget.doc_selector_combo.blockSignals(False)
+            # Revert selection in combo box (signals stay blocked only for this block, even on error)
+            with QSignalBlocker(self.chat_widget.doc_selector_combo):
+                index = self.chat_widget.doc_selector_combo.findText(self.selected_doc_basename or "")
+                self.chat_widget.doc_selector_combo.setCurrentIndex(index if index != -1 else 0)
             return
 
         print(f"Document selection changed to: {selected_basename}")
         self.selected_doc_basename = selected_basename
-        self.current_chat_session = None # Invalidate old session
-        self.current_chat_history = [] # Clear history for new doc
-        self.chat_widget.clear_chat()
+        # Reuse the document's session if one exists, so its cached context is not rebuilt
+        self.current_chat_session = self._chat_sessions.get(selected_basename)
+        self.current_transcript = self._transcripts.setdefault(selected_basename, _Transcript())
+        self.chat_widget.replay_messages(self.current_transcript.messages()) # No AI round-trip needed
         self.update_status(f"Starting chat for document: {selected_basename}...")
 
-        # Start the new session (will trigger AI intro)
+        # Start the new session if needed (will trigger AI intro)
         self._try_start_chat_session()
 
 
+    def _discard_chat_sessions(self, basenames: Optional[List[str]] = None):
+        """Drops cached chat sessions, transcripts and frozen prompts (all, or only for the given documents)."""
+        if basenames is None:
+            self._chat_sessions.clear(); self._transcripts.clear(); self._system_prompts.clear()
+            self._context_cached_docs.clear() # The caches themselves stay in _context_caches for reuse
+            return
+        for basename in basenames:
+            self._chat_sessions.pop(basename, None)
+            self._transcripts.pop(basename, None)
+            self._system_prompts.pop(basename, None)
+            self._context_cached_docs.discard(basename)
+
+
     def _try_start_chat_session(self):
         """Attempts to start a new chat session if conditions are met."""
         if not self.is_ai_configured or not self.model:
             print("Cannot start chat: AI not configured.")
             # Status already set by initialize_ai usually
             return
+        if self.is_processing: return # A task is running, e.g. the chat start _update_ui_state just triggered
         if not self.selected_doc_basename:
              # Try selecting the first available uploaded doc
-             available_docs = list(self.uploaded_files.keys())
-             if available_docs:
-                 print("No document selected, defaulting to first uploaded:", available_docs[0])
-                 # This will trigger handle_document_selection_change -> _try_start_chat_session again
-                 self.chat_widget.doc_selector_combo.setCurrentText(available_docs[0])
+             first_doc = next(iter(self.uploaded_files), None) # No need to copy all keys for one
+             if first_doc:
+                 print("No document selected, defaulting to first uploaded:", first_doc)
+                 # Select without re-entering via the signal, then start the chat explicitly
+                 # (also covers the combo already showing this document, where no signal would fire)
+                 with QSignalBlocker(self.chat_widget.doc_selector_combo):
+                     self.chat_widget.doc_selector_combo.setCurrentText(first_doc)
+                 self.handle_document_selection_change(first_doc)
              else:
                  print("Cannot start chat: No document selected or uploaded.")
                  self.update_status("Select a document (or add/upload files).")
@@ -930,197 +1877,388 @@ class SimpleTutorApp(QMainWindow):
 
         # --- Start New Chat ---
         self.update_status(f"Initializing chat for {self.selected_doc_basename}...", processing=True)
-        doc_file_obj = self.uploaded_files[self.selected_doc_basename]
 
-        # Prepare system instruction
-        system_prompt = self._build_system_prompt(self.selected_doc_basename)
+        # Prepare system instruction. It is frozen for the lifetime of the session (and reused
+        # when older history is summarized) so the conversation prefix stays identical for server-side caching.
+        system_prompt = self._system_prompts[self.selected_doc_basename] = self._build_system_prompt(self.selected_doc_basename)
+
+        # Start the chat session (history is initially empty) in the pool, then send the first turn.
+        # Document + system prompt go into a server-side context cache when possible; otherwise
+        # they are prepended to the first message (see _start_ai_chat_turn).
+        cache_key = self._context_cache_key(self.selected_doc_basename)
+        self._start_worker(ChatInitWorker(self.model, self.selected_doc_basename, self.uploaded_files[self.selected_doc_basename],
+                                          system_prompt, self._model_options, self._context_caches.get(cache_key),
+                                          try_caching=self._context_caches.get(cache_key, True) is not None),
+                           session_ready=self._handle_chat_session_ready,
+                           error_occurred=self._handle_chat_init_error)
+
+
+    @Slot(str, object, object)
+    def _handle_chat_session_ready(self, doc_basename: str, chat_session: ChatSession, cached_content: Optional[Any]):
+        """Stores the new session for its document and sends the AI's introduction turn."""
+        self.worker = None # Init task complete; the introduction turn becomes the current task
+        if doc_basename != self.selected_doc_basename or doc_basename not in self.uploaded_files:
+            if cached_content is not None and cached_content not in self._context_caches.values():
+                self.thread_pool.start(ContextCacheDeleteWorker([cached_content])) # Made for a document that is gone
+            self.update_status("Select a document (or add/upload files).", processing=False); return # Document removed meanwhile
+
+        self.current_chat_session = self._chat_sessions[doc_basename] = chat_session
+        cache_key = self._context_cache_key(doc_basename)
+        previous_cache = self._context_caches.get(cache_key)
+        if previous_cache is not None and previous_cache is not cached_content:
+            self.thread_pool.start(ContextCacheDeleteWorker([previous_cache])) # Replaced because it was about to expire
+        self._drop_context_caches(lambda key: key[1] == cache_key[1] and key != cache_key) # Same file, older prompt
+        self._context_caches[cache_key] = cached_content # None: not tried again for these inputs
+        if cached_content is not None: self._context_cached_docs.add(doc_basename)
+        else: self._context_cached_docs.discard(doc_basename)
+        self.current_transcript = self._transcripts[doc_basename] = _Transcript()
+        print("Chat session started.")
+
+        # Send initial message to AI (including system prompt)
+        # We use the worker to handle the first turn
+        initial_message_to_ai = f"Let's begin. Please provide a brief introduction to the document '{doc_basename}' or suggest a starting point for discussion."
+        self._start_ai_chat_turn(initial_message_to_ai, is_initial_turn=True)
 
-        # Start the chat session (history is initially empty)
-        # Depending on API/model, system prompt might go here or in first message
-        try:
-            # Option 1: System instruction in start_chat (if supported)
-            # self.current_chat_session = self.model.start_chat(
-            #      history=[],
-            #      # system_instruction=system_prompt # Check documentation
-            # )
-            # Option 2: Prepend system instruction implicitly (common)
-            self.current_chat_session = self.model.start_chat(history=[])
-            print("Chat session started.")
 
-            # Send initial message to AI (including system prompt if not set above)
-            # We use the worker to handle the first turn
-            initial_message_to_ai = f"{system_prompt}\n\nLet's begin. Please provide a brief introduction to the document '{self.selected_doc_basename}' or suggest a starting point for discussion."
-            self._start_ai_chat_turn(initial_message_to_ai, is_initial_turn=True)
+    @Slot(str)
+    def _handle_chat_init_error(self, error_message: str):
+        self.worker = None # Task complete
+        msg = f"Failed to start chat session: {error_message}"
+        print(msg)
+        QMessageBox.critical(self, "Chat Error", msg)
+        self.update_status("Error starting chat.", is_error=True, processing=False)
+        self.current_chat_session = None
+        if self.selected_doc_basename: self._discard_chat_sessions([self.selected_doc_basename])
 
 
-        except Exception as e:
-             msg = f"Failed to start chat session: {e}"
-             print(msg)
-             QMessageBox.critical(self, "Chat Error", msg)
-             self.update_status("Error starting chat.", is_error=True, processing=False)
-             self.current_chat_session = None
+    def _context_cache_key(self, doc_basename: str) -> Tuple[str, str, str]:
+        """What a context cache holds: the model, the uploaded file and the frozen system prompt."""
+        return (self.model.model_name, self.uploaded_files[doc_basename].name, self._system_prompts[doc_basename])
+
+    def _drop_context_caches(self, is_stale):
+        """Forgets the context caches whose key is_stale(key), deleting them server-side in the pool (they are billed while they live)."""
+        stale_keys = [key for key in self._context_caches if is_stale(key)]
+        doomed = [cached for cached in (self._context_caches.pop(key) for key in stale_keys) if cached is not None]
+        if doomed: self.thread_pool.start(ContextCacheDeleteWorker(doomed))
 
 
     def _build_system_prompt(self, current_doc_name: str) -> str:
         """Builds the system prompt string."""
-        language = self.config.get('language', DEFAULT_LANGUAGE)
-        # Basic template - can be customized further
-        prompt = (
-            f"You are 'Konenäkö Tutor', an AI assistant for a Machine Vision course teaching in {language}.\n"
-            f"Your goal is to help the student understand the concepts presented ONLY in the provided course document: '{current_doc_name}'.\n"
-            f"The document is provided via the File API and you should have access to it.\n\n"
-            "Based on our chat history and the document content, guide the student:\n"
-            "- Explain concepts clearly.\n"
-            "- Ask relevant questions.\n"
-            "- Provide exercises when appropriate.\n"
-            "- Offer constructive feedback.\n"
-            "- Maintain a supportive, conversational tone.\n"
-            "- Adapt based on the student's input.\n\n"
-            "CRITICAL RULES:\n"
-            "- Base ALL output STRICTLY on the provided document '{current_doc_name}'. If info isn't there, say so.\n"
-            "- Use citations like '[Page X]' or '[Section Y]' when referencing the document.\n"
-            "- Decide the conversational next step (explain, ask, exercise, etc.).\n"
-            "- Wait for the student's input after asking a question or giving an exercise."
-        )
-        return prompt
+        return _render_system_prompt(current_doc_name, self.config.get('language', DEFAULT_LANGUAGE))
+
+
+    def _add_chat_message(self, role: str, text: str):
+        """Shows a message in the chat and records it in the current document's transcript."""
+        self.chat_widget.add_message(role, text)
+        self.current_transcript.append(role, text)
 
 
     @Slot(str)
     def handle_user_message(self, user_text: str):
         """Handles input from the chat widget."""
-        if self.is_processing: QMessageBox.warning(self, "Busy", "Please wait for the AI's response."); return
+        if self.is_processing and not isinstance(self.worker, AIChatWorker):
+            QMessageBox.warning(self, "Busy", "Please wait for the current task to finish."); return
         if not self.current_chat_session:
             QMessageBox.warning(self, "No Chat Active", "Please select an uploaded document to start chatting."); return
 
-        # Add user message to UI and history
-        self.chat_widget.add_message(ROLE_USER, user_text)
-        self.current_chat_history.append({'role': ROLE_USER, 'parts': [user_text]})
+        if self.is_processing: # Held until the answer is complete, so it doesn't land inside the streamed text
+            self._held_user_msgs.append(user_text); return
+        # Show the message right away; it is sent with any others typed in quick succession
+        self._add_chat_message(ROLE_USER, user_text)
+        self._pending_user_msgs.append(user_text)
+        if len(self._pending_user_msgs) == 1 and not self._send_timer.isActive():
+            self._flush_pending_messages() # Nothing to batch with, don't add latency
+        else:
+            self._send_timer.start()
+
+
+    @Slot()
+    def _flush_pending_messages(self):
+        """Sends all queued user messages as a single AI turn."""
+        if self.is_processing or not self._pending_user_msgs: return # Flushed again when the current turn ends
+        if not self.current_chat_session:
+            self._pending_user_msgs.clear(); return
+        user_text = "\n\n".join(self._pending_user_msgs)
+        self._pending_user_msgs.clear()
 
         # Trigger AI response
         self._start_ai_chat_turn(user_text)
 
 
+    def _release_held_messages(self):
+        """Shows the messages typed during the finished turn, after its answer, and sends them as the next turn."""
+        for held_text in self._held_user_msgs:
+            self._add_chat_message(ROLE_USER, held_text)
+        self._pending_user_msgs.extend(self._held_user_msgs); self._held_user_msgs.clear()
+        if self._pending_user_msgs: self._send_timer.start()
+
+
     def _start_ai_chat_turn(self, message_for_ai: str, is_initial_turn: bool = False):
         """Starts the AIChatWorker to get the next response."""
         if not self.current_chat_session or not self.is_ai_configured: return
 
+        # Identical turn (same document, same conversation so far, same message) answered before: no round-trip.
+        # Reads the session history, so it is done before the app is marked busy; if that read fails
+        # the turn simply goes to the worker uncached.
+        self._pending_embedding = None
+        try:
+            self._pending_cache_key = self._response_cache_key(message_for_ai)
+            cached_response = self._response_cache.get(self._pending_cache_key, (None, None))[1]
+            # A paraphrase of an earlier question? Checked by the worker, which also does the embedding
+            semantic_lookup = self._semantic_cache_lookup(message_for_ai) if cached_response is None and not is_initial_turn else None
+        except Exception as e:
+            log.warning("Response cache skipped for this turn: %s", e)
+            self._pending_cache_key = self._pending_semantic_slot = cached_response = semantic_lookup = None
+
         self.update_status("AI is thinking...", processing=True)
+        self.chat_widget.set_input_enabled(False, keep_typing=True) # Messages typed meanwhile are queued
+        self._ai_message_streaming = False
 
         # Pass the current chat session and the latest user message text
         # The worker will use chat_session.send_message which handles history internally
         doc_ref = self.uploaded_files.get(self.selected_doc_basename)
 
-        self.thread = QThread(self)
-        # Pass the ChatSession object itself to the worker
-        self.worker = AIChatWorker(self.current_chat_session, message_for_ai, doc_ref)
-        self.worker.moveToThread(self.thread)
+        system_prompt = self._system_prompts.get(self.selected_doc_basename)
+        context_cache = None # Set if document + prompt are in the session model's cached context (never re-sent)
+        if self.selected_doc_basename in self._context_cached_docs:
+            context_cache = self._context_caches.get(self._context_cache_key(self.selected_doc_basename))
+        history_limit = int(self.config.get('history_limit', DEFAULT_HISTORY_LIMIT))
+
+        if cached_response is not None:
+            print("Reusing cached AI response for an identical turn.")
+            # Record the turn in the session too, exactly as the worker would have sent it
+            context_parts = () if context_cache is not None else (doc_ref, system_prompt)
+            sent_parts = [p for p in (*context_parts, message_for_ai) if p] if is_initial_turn else [message_for_ai]
+            self.current_chat_session.history = [*self.current_chat_session.history,
+                                                 {'role': ROLE_USER, 'parts': sent_parts}, {'role': ROLE_AI, 'parts': [cached_response]}]
+            QTimer.singleShot(0, lambda: self._handle_ai_result(cached_response)) # Still delivered asynchronously, like a worker result
+            return
 
-        # Connections
-        self.worker.result_ready.connect(self._handle_ai_result)
-        self.worker.error_occurred.connect(self._handle_ai_error)
-        self.thread.started.connect(self.worker.run)
-        # Cleanup
-        self.worker.result_ready.connect(self.thread.quit)
-        self.worker.error_occurred.connect(self.thread.quit)
-        self.thread.finished.connect(self._on_thread_finished)
-        self.thread.finished.connect(self.worker.deleteLater)
-        self.thread.finished.connect(self.thread.deleteLater)
+        # Pass the ChatSession object itself to the worker, reusing one worker (and its signal
+        # connections) for every turn. The turn ends in _handle_ai_result/_handle_ai_error.
+        if self._chat_worker is None or not self._chat_worker.is_idle(): # Never block the GUI thread waiting for it
+            if self._chat_worker is not None: self._retire_chat_worker(self._chat_worker) # Still inside run(); never start one instance twice
+            self._chat_worker = self._create_chat_worker()
+        self._chat_worker.prepare_turn(self.current_chat_session, message_for_ai, doc_ref, is_initial_turn, system_prompt, history_limit,
+                                       context_cache, self.model, semantic_lookup)
+        self.worker = self._chat_worker
+        self.thread_pool.start(self._chat_worker)
+
+
+    def _semantic_cache_lookup(self, message: str) -> Optional[Tuple[Any, Optional[Tuple[Any, List[str], List[int]]], int]]:
+        """Returns (embedder, cache entry, conversation id) for the worker to match the message against, or None.
+        Remembers the slot, so the embedding the worker hands back on a miss is stored there."""
+        self._pending_semantic_slot = None
+        if self._embedder is None or len(message.split()) < SEMANTIC_CACHE_MIN_WORDS: return None
+        doc = self.selected_doc_basename
+        slot = (self.model.model_name, doc, self.uploaded_files[doc].name, self._system_prompts.get(doc),
+                len(self.current_chat_session.history) // SEMANTIC_CACHE_BUCKET)
+        self._pending_semantic_slot = slot
+        return self._embedder, self._semantic_cache.get(slot), id(self.current_transcript) # The transcript outlives session rollovers
+
+    @Slot(object)
+    def _handle_question_embedded(self, embedding):
+        if self._is_stale_chat_signal() or self._pending_semantic_slot is None: return
+        self._pending_embedding = (self._pending_semantic_slot, embedding)
+
+    def _store_semantic_cache(self, answer: str):
+        if self._pending_embedding is None or self._embedder is None: return
+        import numpy as np # Available whenever the embedder loaded
+        slot, embedding = self._pending_embedding
+        conversation_id = id(self.current_transcript)
+        entry = self._semantic_cache.get(slot)
+        if entry is None: self._semantic_cache[slot] = (embedding[np.newaxis, :], [answer], [conversation_id]); return
+        keep = SEMANTIC_CACHE_SLOT_SIZE - 1 # Oldest questions drop out, so the slot stays small to search
+        self._semantic_cache[slot] = (np.vstack((entry[0][-keep:], embedding)), entry[1][-keep:] + [answer], entry[2][-keep:] + [conversation_id])
+
+    def _serialize_history(self) -> List[Tuple[str, str]]:
+        """(role, text) of every turn in the current session, read from the ChatSession itself (non-text parts skipped)."""
+        if not self.current_chat_session: return []
+        return [(content.role, ''.join(getattr(part, 'text', '') for part in content.parts))
+                for content in self.current_chat_session.history]
+
+    def _check_history_append_only(self):
+        """Turns are only ever appended to a session, never edited or reordered, so the prefix sent to
+        Gemini stays byte-identical and its prompt cache keeps hitting. Checked when DEBUG logging is on."""
+        if not log.isEnabledFor(logging.DEBUG) or not self.current_chat_session: return
+        history = self._serialize_history()
+        session_id = id(self.current_chat_session) # A summarized rollover is a new session with a new prefix
+        if self._history_snapshot is not None and self._history_snapshot[0] == session_id:
+            frozen = self._history_snapshot[1]
+            assert history[:len(frozen)] == frozen, "Chat history prefix was modified"
+        self._history_snapshot = (session_id, history)
+
+    def _create_chat_worker(self) -> AIChatWorker:
+        worker = AIChatWorker(cancel_event=self._cancel_event)
+        queued = Qt.ConnectionType.QueuedConnection # Emitted from a pool thread, delivered on the GUI thread
+        signals = worker.signals
+        signals.chunk_ready.connect(self._handle_ai_chunk, queued)
+        signals.result_ready.connect(self._handle_ai_result, queued)
+        signals.error_occurred.connect(self._handle_ai_error, queued)
+        signals.session_reset.connect(self._handle_session_reset, queued)
+        signals.question_embedded.connect(self._handle_question_embedded, queued)
+        return worker
+
+    def _retire_chat_worker(self, worker: AIChatWorker):
+        """Cuts off a worker that is being replaced: it stops emitting, and anything it already queued is ignored (_is_stale_chat_signal)."""
+        worker.stop()
+        for signal in (worker.signals.chunk_ready, worker.signals.result_ready, worker.signals.error_occurred,
+                       worker.signals.session_reset, worker.signals.question_embedded):
+            signal.disconnect()
+
+    def _is_stale_chat_signal(self) -> bool:
+        """True inside a chat slot invoked by a retired worker (cached answers reach the slots without one)."""
+        sender = self.sender()
+        return isinstance(sender, _ChatSignals) and (self._chat_worker is None or sender is not self._chat_worker.signals)
+
+    def _purge_cached_answers(self, file_ids: set):
+        """Forgets cached answers about the given uploaded files; a re-added file with the same name is a new document."""
+        for key in [k for k, (file_id, _) in self._response_cache.items() if file_id in file_ids]:
+            del self._response_cache[key]
+        for slot in [s for s in self._semantic_cache if s[2] in file_ids]:
+            del self._semantic_cache[slot]
+
+    def _response_cache_key(self, message: str) -> str:
+        """Digest identifying a turn by its model, document (and which upload of it), system prompt (language),
+        the conversation so far and the normalized message."""
+        doc = self.selected_doc_basename
+        payload = json.dumps({"model": self.model.model_name, "doc": doc, "file": self.uploaded_files[doc].name, "prompt": self._system_prompts.get(doc),
+                              "hist": self._serialize_history(), "msg": message.strip().lower()}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
-        self.thread.start()
+
+    @Slot(str)
+    def _handle_ai_chunk(self, chunk_text: str):
+        """Renders a streamed piece of the AI response as soon as it arrives."""
+        if self._is_stale_chat_signal(): return
+        if not self._ai_message_streaming:
+            self.chat_widget.begin_streamed_message(ROLE_AI)
+            self._ai_message_streaming = True
+        self.chat_widget.append_chunk(chunk_text)
 
 
     @Slot(str)
     def _handle_ai_result(self, ai_response_text: str):
-        """Handles the AI response text from the worker."""
-        # Add AI response to UI and history
-        self.chat_widget.add_message(ROLE_AI, ai_response_text)
-        # The ChatSession object internally updates its history, but we might
-        # want our own copy for potential future use (e.g. saving/loading chat)
-        # Note: Gemini API might not expose history easily after send_message.
-        # If we need to reconstruct history, store it manually here.
-        self.current_chat_history.append({'role': ROLE_AI, 'parts': [ai_response_text]})
+        """Handles the complete AI response text from the worker."""
+        if self._is_stale_chat_signal(): return
+        # Add AI response to UI (unless it was already streamed in) and history
+        if not self._ai_message_streaming:
+            self.chat_widget.add_message(ROLE_AI, ai_response_text)
+        self.current_transcript.append(ROLE_AI, ai_response_text)
+        self._ai_message_streaming = False
+        if self._pending_cache_key and self.selected_doc_basename in self.uploaded_files:
+            self._response_cache[self._pending_cache_key] = (self.uploaded_files[self.selected_doc_basename].name, ai_response_text)
+            self._response_cache.move_to_end(self._pending_cache_key)
+            if len(self._response_cache) > RESPONSE_CACHE_SIZE: self._response_cache.popitem(last=False) # Evict least recently used
+            self._pending_cache_key = None
+        self._store_semantic_cache(ai_response_text); self._pending_embedding = None
+        self.worker = None # Turn complete
+        # The ChatSession already holds the turn in its history; no client-side copy is kept
+        self._check_history_append_only()
 
         self.update_status(f"Chatting about: {self.selected_doc_basename}", processing=False)
+        self._release_held_messages() # Send what was typed during this turn
+
+
+    @Slot(object)
+    def _handle_session_reset(self, new_session: ChatSession):
+        """Adopts the session the worker restarted (older history summarized or trimmed, or an expired context cache left behind)."""
+        if self._is_stale_chat_signal(): return
+        print(f"Chat session for '{self.selected_doc_basename}' rolled over to a new session.")
+        self.current_chat_session = new_session
+        if self.selected_doc_basename:
+            self._chat_sessions[self.selected_doc_basename] = new_session
+            if getattr(new_session.model, 'cached_content', None) is None: # Now on the plain model, document + prompt in its history
+                self._context_cached_docs.discard(self.selected_doc_basename)
 
 
     @Slot(str)
     def _handle_ai_error(self, error_message: str):
         """Handles errors from the AIChatWorker."""
+        if self._is_stale_chat_signal(): return
         print(f"AI Chat Error: {error_message}")
-        self.chat_widget.add_message(ROLE_SYSTEM, f"Error: {error_message}") # Show error in chat
+        self._ai_message_streaming = False # Any partial answer stays visible above the error
+        self._pending_cache_key = None; self._pending_embedding = None # Errors are never cached
+        self.worker = None # Turn complete
+        self._add_chat_message(ROLE_SYSTEM, f"Error: {error_message}") # Show error in chat
         self.update_status(f"AI Error: {error_message.split(':')[0]}", is_error=True, processing=False)
+        self._release_held_messages() # Send what was typed during this turn
 
 
     # --- UI State Update ---
     def _update_ui_state(self):
-        """Updates UI elements based on current application state."""
-        # Update file list in settings
-        local_basenames = list(self.local_file_paths.keys())
-        self.settings_widget.update_file_list(local_basenames)
-
-        # Update document selector in chat (use only *uploaded* files)
-        uploaded_basenames = list(self.uploaded_files.keys())
-        self.chat_widget.update_document_list(uploaded_basenames)
-
-        # Enable/disable upload button
-        can_upload = bool(self.local_file_paths) and self.is_ai_configured
-        self.settings_widget.upload_button.setEnabled(can_upload)
-
-        # Select current document if possible
-        if self.selected_doc_basename and self.selected_doc_basename in uploaded_basenames:
-             if self.chat_widget.doc_selector_combo.currentText() != self.selected_doc_basename:
-                  self.chat_widget.doc_selector_combo.setCurrentText(self.selected_doc_basename)
-        elif uploaded_basenames: # Select first available if none selected
-            if self.chat_widget.doc_selector_combo.currentIndex() == -1:
-                 self.chat_widget.doc_selector_combo.setCurrentIndex(0)
-                 # Trigger selection change handler to start chat? Be careful of loops.
-                 # It might be better to trigger _try_start_chat_session explicitly after UI update.
-                 # QTimer.singleShot(0, lambda: self.handle_document_selection_change(uploaded_basenames[0]))
-
-
-    # --- Thread Finish ---
-    @Slot()
-    def _on_thread_finished(self):
-        """Called when AI or Upload thread finishes."""
-        print("Background thread finished.")
-        # Check if it was AI or Upload? Doesn't strictly matter for status update.
-        if self.worker is not None: # Check if worker exists before clearing
-             if isinstance(self.worker, AIChatWorker):
-                 # Re-enable input after AI turn if no error occurred during processing
-                 if not self.is_processing: # Check the flag which _handle_* methods should update
-                     self.set_controls_enabled(True)
-             elif isinstance(self.worker, PDFUploadWorker):
-                  # Upload finished, controls already re-enabled by update_status
-                  pass
-        else: # Thread finished but worker was already cleared (e.g., during close)
-             self.set_controls_enabled(True) # Ensure controls are enabled
-
-        self.thread = None
-        self.worker = None
-        # Don't reset self.is_processing here, rely on update_status calls
+        """Updates UI elements based on current application state (one repaint, no selection signals mid-update)."""
+        combo = self.chat_widget.doc_selector_combo
+        auto_selected = None # Document picked here; its handler runs once the widgets are consistent
+        self.setUpdatesEnabled(False) # Children stay frozen too, even if they toggle their own updates
+        try:
+            with QSignalBlocker(combo): # Our own setCurrent* calls must not re-enter handle_document_selection_change
+                # Update file list in settings (if it has been opened; show_settings_view refreshes it otherwise)
+                if self.settings_widget:
+                    self.settings_widget.update_file_list(self.local_file_paths.keys()) # A view, not a copy; the widget snapshots it once
+
+                # Update document selector in chat (use only *uploaded* files)
+                self.chat_widget.update_document_list(self.uploaded_files.keys())
+
+                # Enable/disable upload button
+                can_upload = bool(self.local_file_paths) and self.is_ai_configured
+                if self.settings_widget: self.settings_widget.upload_button.setEnabled(can_upload)
+
+                # Select current document if possible
+                if self.selected_doc_basename and self.selected_doc_basename in self.uploaded_files:
+                     if combo.currentText() != self.selected_doc_basename:
+                          combo.setCurrentText(self.selected_doc_basename)
+                elif self.uploaded_files: # Selection gone or never made: adopt what the selector shows (its first entry if nothing)
+                    if combo.currentIndex() == -1: combo.setCurrentIndex(0)
+                    if combo.currentText() != self.selected_doc_basename: auto_selected = combo.currentText()
+        finally:
+            self.setUpdatesEnabled(True) # Single repaint for everything above
+        if auto_selected:
+            self.handle_document_selection_change(auto_selected) # Explicitly, instead of via the blocked signal
+
+
+    # --- Background Tasks ---
+    def _start_worker(self, worker, **slots):
+        """Runs a foreground task in the shared pool, connecting its signals (by name) to the given slots."""
+        queued = Qt.ConnectionType.QueuedConnection # Emitted from a pool thread, delivered on the GUI thread
+        for signal_name, slot in slots.items():
+            getattr(worker.signals, signal_name).connect(slot, queued)
+        self.worker = worker
+        self.thread_pool.start(worker)
 
 
     # --- Window Closing ---
     def closeEvent(self, event):
-        """Handles window closing, saves config, stops threads."""
-        if self.is_processing and self.thread and self.thread.isRunning():
-            reply = QMessageBox.question(self, "Confirm Exit", "A background task is running. Quit anyway?", QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No, QMessageBox.StandardButton.No)
-            if reply == QMessageBox.StandardButton.Yes:
-                print("Stopping background task on close...")
-                if self.worker: self.worker.stop()
-                self.thread.quit()
-                if not self.thread.wait(1000): self.thread.terminate()
-            else:
-                event.ignore(); return
-
-        self.save_config()
+        """Handles window closing: cancels background work cooperatively, saves config."""
+        if self._close_ready:
+            event.accept(); return
+        if self._closing:
+            event.ignore(); return # Already closing, waiting for the config write
+        # No confirmation and no waiting: workers see the flag at their next check and exit on their own
+        self._cancel_event.set()
+        if self._chat_worker: self._chat_worker.stop()
+        self._drop_context_caches(lambda key: True) # Not reused after exit; don't leave them billed until they expire
+        if self.is_processing and self.worker is not None:
+            log.debug("Cancelling background task on close...")
+            self.worker.stop()
+
+        self._save_timer.stop() # Flush any pending debounced save now
         # Optionally delete backend files on close? Could be annoying.
         # self._attempt_backend_deletion(list(self.uploaded_files.values()))
+        # The final write happens on the GUI thread: it takes milliseconds, while a pool task could
+        # queue behind a stuck upload or chat turn and keep the window open indefinitely.
+        if self._config_save_in_flight and self.thread_pool.tryTake(self._config_save_worker):
+            self._config_save_in_flight = False; self._config_save_worker = None # Never started; superseded by the write below
+        if self._config_save_in_flight: # Already writing: let it land first, so it can't overwrite the final write
+            self._closing = True # Further close requests are ignored until _background_save_finished closes the window
+            event.ignore(); return
+        self.save_config() # Reports a failure before the window goes away
         event.accept()
 
 
 # --- Main Execution ---
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING) # Raise to DEBUG to trace worker activity
     app = QApplication(sys.argv)
     window = SimpleTutorApp()
     window.show()